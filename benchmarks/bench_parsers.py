@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""
+   bench_parsers : benchmark and regression harness for the parsing paths of check_mk_docker.py and
+                   check_mk_dnsdist.py.
+
+   The recorded docker cli output and dnsdist api payload in fixtures/ are scaled up to the requested number of
+   containers/backends with a seeded generator, so every run replays exactly the same data. Each parser is run in
+   a forked child against the replayed data and reports its time per run, rows and MB parsed per second and the
+   peak memory, and the check_mk output it produced is compared with the hash recorded in golden.txt. A parser whose
+   output changed fails the run, so a performance change can be shown to leave the output byte for byte identical.
+
+   Parsers:
+     docker_ps     : docker ps -> running container list, Docker_Containers and Container_* up checks
+     docker_stats  : docker stats -> Docker Metrics, per container cpu/memory and the totals
+     docker_rows   : docker stats -> container samples only, the row parser without the output
+     docker_info   : docker info -> Docker_DataStores (devicemapper data/metadata space)
+     dnsdist       : two consecutive /api/v1/servers/localhost payloads -> pool and per backend services
+     dnsdist_steady: one more payload once the state file holds a full latency window, as on a long running host
+
+   Usage:
+     python benchmarks/bench_parsers.py                  check every parser at 10, 1000 and 10000 rows
+     python benchmarks/bench_parsers.py -p dnsdist -s 1000
+     python benchmarks/bench_parsers.py --record         rewrite golden.txt after an intended output change
+
+   Version      Author          Date        Description
+     0.1                        18-10-2026  Initial version
+     0.2                        18-10-2026  docker_rows parser
+     0.3                        18-10-2026  dnsdist_steady parser
+
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import resource
+import optparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import check_mk_docker
+import check_mk_dnsdist
+
+FIXTURES = os.path.join(HERE, 'fixtures')
+GOLDEN = os.path.join(HERE, 'golden.txt')
+SEED = 20180206
+
+
+def read_fixture(name):
+    f = open(os.path.join(FIXTURES, name), 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def pad(columns, widths):
+    """
+    Lay out columns the way the docker cli does, every column at least two spaces from the next
+    """
+    return "".join([c.ljust(max(w, len(c) + 3)) for c, w in zip(columns, widths)]).rstrip()
+
+
+def scale_docker(rows):
+    """
+    Generate the ps, stats and info output of a host running rows containers from the recorded output. Containers
+    take their columns from the recorded container in the same position with the cpu and memory usage varied.
+
+    :return : (dict) {docker sub command: output}
+    """
+    rng = random.Random(SEED)
+    recorded_ps = [l.split('\t') for l in read_fixture('docker_ps.txt').splitlines()]
+    stats = read_fixture('docker_stats.txt').splitlines()
+    widths = [20, 20, 24, 20, 22, 22, 0]
+    recorded_stats = [[c.strip() for c in l.replace(' / ', '/').split('  ') if c.strip()] for l in stats[1:]]
+
+    ps = []
+    stats = [stats[0]]
+    for i in range(rows):
+        name = recorded_ps[i % len(recorded_ps)][1] + '-' + str(i)
+        ps.append(hashlib.sha256(name).hexdigest() + '\t' + name)
+        columns = list(recorded_stats[i % len(recorded_stats)])
+        used, limit = columns[2].split('/')
+        value, unit = used.split(' ')
+        columns[0] = name
+        columns[1] = "{0:.2f}%".format(float(columns[1].rstrip('%')) * rng.uniform(0.2, 3.0))
+        columns[2] = "{0:.4g} {1} / {2}".format(float(value) * rng.uniform(0.5, 1.5), unit, limit)
+        columns[3] = "{0:.2f}%".format(float(columns[3].rstrip('%')) * rng.uniform(0.5, 1.5))
+        columns[4] = columns[4].replace('/', ' / ')
+        columns[5] = columns[5].replace('/', ' / ')
+        stats.append(pad(columns, widths))
+
+    info = read_fixture('docker_info.txt').replace('Containers: 5\n Running: 5',
+                                                   'Containers: {0}\n Running: {0}'.format(rows))
+    return {'ps': "\n".join(ps) + "\n", 'stats': "\n".join(stats) + "\n", 'info': info}
+
+
+def scale_dnsdist(rows):
+    """
+    Generate two consecutive servers payloads a minute apart for a dnsdist with rows backends from the recorded
+    payload. Backends are spread over a pool per 25 backends and every 20th one is down.
+
+    :return : (list) the two json bodies
+    """
+    rng = random.Random(SEED)
+    recorded = json.loads(read_fixture('dnsdist_servers.json'))
+    pools = max(2, rows // 25)
+    first = []
+    second = []
+    for i in range(rows):
+        server = dict(recorded['servers'][i % len(recorded['servers'])])
+        server['id'] = i
+        server['name'] = server['name'] + '-' + str(i)
+        server['address'] = "10.{0}.{1}.{2}:53".format(i // 65536 % 256, i // 256 % 256, i % 256)
+        server['pools'] = ["pool" + str(i % pools)]
+        if i % 20 == 19:
+            server['state'] = 'down'
+            server['latency'] = None
+            server['qps'] = 0.0
+        else:
+            server['state'] = 'up'
+            server['latency'] = round(rng.uniform(0.2, 60.0), 1)
+            server['qps'] = float(rng.randint(0, 2000))
+        server['queries'] = rng.randint(0, 10 ** 9)
+        server['drops'] = rng.randint(0, 10 ** 5)
+        server['outstanding'] = rng.randint(0, 12)
+        first.append(server)
+        server = dict(server)
+        server['queries'] += int(server['qps'] * 60)
+        server['drops'] += rng.randint(0, 600)
+        second.append(server)
+
+    payloads = []
+    for servers in (first, second):
+        document = dict(recorded)
+        document['servers'] = servers
+        payloads.append(json.dumps(document, sort_keys=True))
+    return payloads
+
+
+class ReplayCLI(check_mk_docker.DockerCLI):
+    """
+    Docker cli client answering every command with recorded output, so the real cli parsing is measured
+    """
+    def __init__(self, outputs):
+        check_mk_docker.DockerCLI.__init__(self, 'docker')
+        self.outputs = outputs
+
+    def Run(self, args, timeout=None):
+        return self.outputs[args[0]]
+
+
+class FrozenClock:
+    """
+    Stands in for the time module of check_mk_dnsdist so the rates it calculates do not depend on when it runs
+    """
+    def __init__(self, now=1500000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def docker_setup(outputs):
+    p = check_mk_docker.dockermon()
+    p.docker = ReplayCLI(outputs)
+    p.DisplayAllContainers = "true"
+    p.ParallelStats = "no"
+    p.monitorlist = ['api-gateway-1', 'ghost', 'web-frontend-1-*', 're:^redis-cache-[0-9]+$']
+    return p
+
+
+def docker_ps_run(p):
+    p.RunningContainerList()
+    p.MonitorNumInstances()
+    p.MonitorIsContainerUp()
+    return p.out.render()
+
+
+def docker_stats_setup(outputs):
+    p = docker_setup(outputs)
+    p.RunningContainerList()
+    return p
+
+
+def docker_stats_run(p):
+    p.MonitorMetrics()
+    return p.out.render()
+
+
+def docker_rows_run(p):
+    return "".join(["{0} {1} {2} {3} {4}\n".format(s.name, s.cpu, s.mem, s.memused, s.memtotal)
+                    for s in p.docker.StatsAll(p.running_containers)])
+
+
+def docker_info_run(p):
+    p.MonitorMetaDataStores()
+    return p.out.render()
+
+
+def dnsdist_setup(payloads):
+    check = check_mk_dnsdist.check_mk_dnsdist()
+    check.state_file = os.path.join(tempfile.mkdtemp(prefix='bench_dnsdist'), 'dnsdist.state')
+    check.per_backend = 1
+    check.backend_latency_warn = 20
+    check.backend_latency_crit = 40
+    check.backend_outstanding_warn = 8
+    check.backend_drop_rate_warn = 5
+    return check, payloads, FrozenClock().now
+
+
+def dnsdist_steady_setup(payloads):
+    """
+    Run the payloads, then fill the latency window of every pool to latency_window runs as if the plugin had been
+    running for that long. The run measured is the one after.
+    """
+    check, payloads, now = dnsdist_setup(payloads)
+    clock = check_mk_dnsdist.time = FrozenClock(now)
+    try:
+        for body in payloads:
+            check.data = {'servers': check_mk_dnsdist.extract_json_key(body, 'servers')}
+            check.process_data()
+            clock.now += 60
+    finally:
+        check_mk_dnsdist.time = time
+    state = check.load_state()
+    window = int(check.latency_window)
+    for pool, runs in state['latency'].items():
+        state['latency'][pool] = (runs * window)[-window:]
+    check.save_state(state)
+    check.output = check_mk_dnsdist.OutputBuffer()
+    check.budget = check_mk_dnsdist.TimeBudget(0, check.output)
+    return check, payloads[-1:], clock.now
+
+
+def dnsdist_run(state):
+    check, payloads, now = state
+    clock = check_mk_dnsdist.time = FrozenClock(now)
+    try:
+        for body in payloads:
+            check.data = {'servers': check_mk_dnsdist.extract_json_key(body, 'servers')}
+            check.process_data()
+            clock.now += 60
+    finally:
+        check_mk_dnsdist.time = time
+        shutil.rmtree(os.path.dirname(check.state_file))
+    return check.output.render()
+
+
+# parser -> (fixture generator, bytes of the fixture it parses, setup, run). setup is not timed and is repeated for
+# every run.
+PARSERS = {
+    'docker_ps': (scale_docker, lambda outputs: len(outputs['ps']), docker_setup, docker_ps_run),
+    'docker_stats': (scale_docker, lambda outputs: len(outputs['stats']), docker_stats_setup, docker_stats_run),
+    'docker_rows': (scale_docker, lambda outputs: len(outputs['stats']), docker_stats_setup, docker_rows_run),
+    'docker_info': (scale_docker, lambda outputs: len(outputs['info']), docker_setup, docker_info_run),
+    'dnsdist': (scale_dnsdist, lambda payloads: sum([len(p) for p in payloads]), dnsdist_setup, dnsdist_run),
+    'dnsdist_steady': (scale_dnsdist, lambda payloads: len(payloads[-1]), dnsdist_steady_setup, dnsdist_run),
+}
+ORDER = ['docker_ps', 'docker_stats', 'docker_rows', 'docker_info', 'dnsdist', 'dnsdist_steady']
+
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(parser, rows, min_time):
+    """
+    Run a parser repeatedly for at least min_time seconds (and at least 3 times)
+
+    :return : (dict) best time per run, bytes parsed, peak memory and the hash of the output of the last run
+    """
+    generate, size, setup, run = PARSERS[parser]
+    fixture = generate(rows)
+    gc.collect()
+    baseline = maxrss()
+    runs = 0
+    best = None
+    started = time.time()
+    while runs < 3 or time.time() - started < min_time:
+        state = setup(fixture)
+        t = time.time()
+        output = run(state)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+        runs += 1
+    return {'runs': runs, 'best': best, 'bytes': size(fixture), 'peak': maxrss(), 'growth': maxrss() - baseline,
+            'sha1': hashlib.sha1(output).hexdigest(), 'lines': output.count('\n')}
+
+
+def measure_in_child(parser, rows, min_time):
+    """
+    Measure in a forked child so the peak memory of one parser and size is not hidden by an earlier one
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            result = measure(parser, rows, min_time)
+        except Exception, e:
+            result = {'error': repr(e)}
+        os.write(write, json.dumps(result))
+        os._exit(0)
+    os.close(write)
+    data = ''
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def load_golden():
+    golden = {}
+    if os.path.isfile(GOLDEN):
+        for l in open(GOLDEN, 'r').readlines():
+            if l.startswith('#') or l.strip() == '':
+                continue
+            parser, rows, sha1, lines = l.split()
+            golden[(parser, int(rows))] = (sha1, int(lines))
+    return golden
+
+
+def save_golden(golden):
+    f = open(GOLDEN, 'w')
+    try:
+        f.write("# parser rows sha1-of-output output-lines, written by bench_parsers.py --record\n")
+        for parser in ORDER:
+            for key in sorted([k for k in golden.keys() if k[0] == parser]):
+                f.write("{0} {1} {2} {3}\n".format(parser, key[1], golden[key][0], golden[key][1]))
+    finally:
+        f.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-p', '--parser', action='append', help="parser to run, repeat for several (default all)")
+    parser.add_option('-s', '--scale', default='10,1000,10000', help="comma separated row counts [%default]")
+    parser.add_option('-t', '--min-time', type='float', default=1.0, help="seconds to repeat each run for [%default]")
+    parser.add_option('--record', action='store_true', help="record the output hashes in golden.txt")
+    options = parser.parse_args()[0]
+
+    golden = load_golden()
+    failed = 0
+    print "{0:<14}{1:>7}{2:>6}{3:>11}{4:>10}{5:>8}{6:>10}{7:>11}  {8}".format(
+        'parser', 'rows', 'runs', 'ms/run', 'rows/s', 'MB/s', 'peak KB', 'growth KB', 'output')
+    for name in options.parser or ORDER:
+        for rows in [int(r) for r in options.scale.split(',')]:
+            result = measure_in_child(name, rows, options.min_time)
+            if 'error' in result:
+                print "{0:<14}{1:>7}  failed {2}".format(name, rows, result['error'])
+                failed += 1
+                continue
+            expected = golden.get((name, rows))
+            if options.record:
+                golden[(name, rows)] = (result['sha1'], result['lines'])
+                verdict = 'recorded'
+            elif expected is None:
+                verdict = 'no golden hash'
+                failed += 1
+            elif expected != (result['sha1'], result['lines']):
+                verdict = 'CHANGED ({0} lines, {1} recorded)'.format(result['lines'], expected[1])
+                failed += 1
+            else:
+                verdict = 'identical'
+            print "{0:<14}{1:>7}{2:>6}{3:>11.3f}{4:>10.0f}{5:>8.2f}{6:>10}{7:>11}  {8}".format(
+                name, rows, result['runs'], result['best'] * 1000, rows / result['best'],
+                result['bytes'] / result['best'] / 1048576, result['peak'], result['growth'], verdict)
+            sys.stdout.flush()
+    if options.record:
+        save_golden(golden)
+    return failed and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+   bench_startup : startup time of the check_mk_docker and check_mk_dnsdist executables against a target.
+
+   The agent starts every plugin on every poll, so what a run costs before it does any work is paid on every host
+   every minute. Each scenario starts the executable the agent runs, with MK_CONFDIR and MK_VARDIR pointing at a
+   scratch directory, a number of times and the median wall time is compared with the bare interpreter start. For
+   a run which does no work past starting up the difference has to stay within the target.
+
+   Scenarios:
+     docker_spool    : check_mk_docker answering from a fresh --daemon spool file, held to the target
+     dnsdist_down    : check_mk_dnsdist with two instances whose api refuses the connection. Every run polls the
+                       api, which needs httplib (and with it ssl), so this is reported but not held to the target
+
+   The executables are stubs importing the plugin as a module, so the plugin is compiled once and its bytecode
+   reused. Running the plugin itself as a script, as before, compiles all of it on every start, that is reported
+   next to each scenario for comparison (docker_spool.py, dnsdist_down.py). The docker scenarios need a
+   /usr/bin/docker, without one the plugin exits straight away and they are skipped.
+
+   Usage:
+     python benchmarks/bench_startup.py                 measure with the plugins next to this directory
+     python benchmarks/bench_startup.py -n 50 -d DIR    50 starts each, plugins from DIR
+
+   Version      Author          Date        Description
+     0.1                        18-10-2026  Initial version
+     0.2                        18-10-2026  Time the executables the agent runs instead of importing the plugins
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# milliseconds a scenario may take on top of the bare interpreter start
+TARGET_MS = 10
+TARGETED = ('docker_spool',)
+
+
+def write(path, data):
+    f = open(path, 'w')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def prepare(plugins, workdir):
+    """
+    Write the configs and spool file the scenarios use
+
+    :return : (dict) scenario -> (command, text the output has to contain)
+    """
+    spool = os.path.join(workdir, 'dockermon.spool')
+    write(spool, "0 Docker_Service service_uptime=1 Docker daemon is running\n")
+    write(os.path.join(workdir, 'dockermon.conf'),
+          "#\n# bench_startup\n#\nSpoolFile={0}\nSpoolMaxAge=3600\nmonitor=web\nmonitor=db\n".format(spool))
+    # nothing listens on port 1, the connection is refused straight away
+    write(os.path.join(workdir, 'check_mk_dnsdist.conf'),
+          "time_budget=50\nstate_file={0}\n[vip1]\nurl=\"http://127.0.0.1:1/\"\n[vip2]\nurl=\"http://127.0.0.1:1/\"\n"
+          .format(os.path.join(workdir, 'check_mk_dnsdist.state')))
+    # a plugin run as a script leaves the check to its executable when that is installed next to it
+    scripts = os.path.join(workdir, 'scripts')
+    os.mkdir(scripts)
+    for plugin in ('check_mk_docker.py', 'check_mk_dnsdist.py', 'check_mk_common.py'):
+        shutil.copy(os.path.join(plugins, plugin), scripts)
+    return {
+        'python': ([sys.executable, '-c', ''], ''),
+        'docker_spool': ([sys.executable, os.path.join(plugins, 'check_mk_docker')], 'Docker_Service'),
+        'docker_spool.py': ([sys.executable, os.path.join(scripts, 'check_mk_docker.py')], 'Docker_Service'),
+        'dnsdist_down': ([sys.executable, os.path.join(plugins, 'check_mk_dnsdist')], 'dnsdist_vip2_api'),
+        'dnsdist_down.py': ([sys.executable, os.path.join(scripts, 'check_mk_dnsdist.py')], 'dnsdist_vip2_api'),
+    }
+
+
+def start(scenario, env):
+    """
+    :return : (float) wall seconds of one start of the scenario
+    """
+    command, expected = scenario
+    started = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    elapsed = time.time() - started
+    if proc.returncode != 0 or expected not in out:
+        raise RuntimeError("scenario failed ({0}): {1}".format(proc.returncode, (err or out).strip()))
+    return elapsed
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--runs', type='int', default=20, help="starts per scenario [%default]")
+    parser.add_option('-d', '--plugins', default=os.path.dirname(HERE), help="directory holding the plugins")
+    options = parser.parse_args()[0]
+
+    names = ['python', 'docker_spool', 'docker_spool.py', 'dnsdist_down', 'dnsdist_down.py']
+    if not os.path.isfile('/usr/bin/docker'):
+        names = [name for name in names if not name.startswith('docker')]
+    workdir = tempfile.mkdtemp(prefix='bench_startup')
+    try:
+        env = dict(os.environ, MK_CONFDIR=workdir, MK_VARDIR=workdir)
+        # as started by the agent, which lets python write the bytecode the executables rely on
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        scenarios = prepare(os.path.abspath(options.plugins), workdir)
+        results = {}
+        for name in names:
+            # the first start writes the config caches and bytecode and warms the page cache
+            start(scenarios[name], env)
+            results[name] = median([start(scenarios[name], env) for i in range(options.runs)]) * 1000
+    finally:
+        shutil.rmtree(workdir)
+
+    failed = 0
+    baseline = results['python']
+    print "{0:<17}{1:>10}{2:>12}  {3}".format('scenario', 'ms', 'overhead', 'target')
+    print "{0:<17}{1:>10.1f}".format('python', baseline)
+    for name in names[1:]:
+        elapsed = results[name]
+        overhead = elapsed - baseline
+        if name.endswith('.py'):
+            verdict = "plugin run as a script, for comparison"
+        elif name not in TARGETED:
+            verdict = "polls the api, no target"
+        elif overhead <= TARGET_MS:
+            verdict = "ok (<= {0}ms)".format(TARGET_MS)
+        else:
+            verdict = "MISSED (> {0}ms)".format(TARGET_MS)
+            failed += 1
+        print "{0:<17}{1:>10.1f}{2:>12.1f}  {3}".format(name, elapsed, overhead, verdict)
+    if not os.path.isfile('/usr/bin/docker'):
+        print "docker_spool     skipped, check_mk_docker exits without a /usr/bin/docker"
+    return failed and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
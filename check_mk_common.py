@@ -0,0 +1,393 @@
+"""
+   check_mk_common : shared runtime for the python check_mk local plugins (check_mk_docker.py, check_mk_dnsdist.py).
+                     This is not a check itself, install it next to the plugins without the execute bit so the agent
+                     does not try to run it.
+
+   Version      Author          Date        Description
+     0.1                        18-10-2026  Initial version, output buffer and run time budget
+     0.2                        18-10-2026  Instrumentation mode with per step timings and an optional profile
+     0.3                        18-10-2026  Lazy imports and a config loader cached on the mtime of the config
+     0.4                        18-10-2026  Config values are everything after the first '='
+     0.5                        18-10-2026  TimeBudget.buffer for steps adding many lines
+
+"""
+import gc
+import os
+import sys
+import time
+import marshal
+
+
+class LazyModule:
+    """
+    Stands in for a module which is only imported the first time one of its attributes is used, so runs which never
+    need it (generating a config, answering from the spool) do not pay for importing it. Attributes are cached on
+    the proxy as they are looked up.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        value = getattr(__import__(self._name), attr)
+        self.__dict__[attr] = value
+        return value
+
+
+threading = LazyModule('threading')
+
+# part of the key of cached configs, changed whenever read_config reads a config differently
+CONFIG_CACHE_FORMAT = 2
+
+
+def read_config(configfile, cachefile=None):
+    """
+    Read a key=value config file into a list of (key, value) pairs in file order, a [name] section header becomes
+    ('[', name). Comments and lines without a '=' are skipped and the value is everything after the first '=', so
+    values such as urls and per container settings can contain '=' themselves.
+
+    The pairs are kept in cachefile with marshal together with the mtime and size of the config, so while the config
+    is unchanged loading it costs a stat and a small read rather than parsing it again.
+
+    :param configfile : config to read
+    :param cachefile  : where the parsed config is cached, None to always parse
+    :return           : (list) of (key, value) tuples
+    """
+    stat = os.stat(configfile)
+    key = [CONFIG_CACHE_FORMAT, configfile, stat.st_mtime, stat.st_size]
+    if cachefile:
+        try:
+            f = open(cachefile, 'rb')
+            try:
+                cached = marshal.load(f)
+            finally:
+                f.close()
+            if cached[0] == key:
+                return cached[1]
+        except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+            pass
+
+    pairs = []
+    f = open(configfile, 'r')
+    try:
+        lines = f.readlines()
+    finally:
+        f.close()
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        setting = line.strip()
+        if len(setting) > 2 and setting[0] == '[' and setting[-1] == ']':
+            pairs.append(('[', setting[1:-1].strip()))
+        elif '=' in setting:
+            name, value = line.rstrip().split('=', 1)
+            pairs.append((name.strip(), value))
+
+    if cachefile:
+        temp = cachefile + '.' + str(os.getpid())
+        try:
+            f = open(temp, 'wb')
+            try:
+                marshal.dump([key, pairs], f)
+            finally:
+                f.close()
+            os.rename(temp, cachefile)
+        except (IOError, OSError):
+            pass
+    return pairs
+
+
+class OutputBuffer:
+    """
+    Collects local check lines for the whole run and writes them out with a single write, so the agent never sees
+    half of the output and rendering hundreds of lines costs one join.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def add(self, status=0, checkname='', perfdata='-', description=''):
+        self.lines.append([status, checkname, perfdata, description])
+
+    def extend(self, other):
+        self.lines.extend(other.lines)
+
+    def add_duration(self, seconds):
+        """
+        Add a check_duration perfdata value to every line in the buffer
+        """
+        duration = "check_duration={0:.3f}".format(seconds)
+        for line in self.lines:
+            if line[2] == '-' or line[2] == '':
+                line[2] = duration
+            else:
+                line[2] = str(line[2]) + "|" + duration
+
+    def render(self):
+        """
+        :return : (str) the buffered lines formatted for check_mk
+        """
+        return "".join(["{0} {1} {2} {3}\n".format(*line) for line in self.lines])
+
+    def flush(self, out=None):
+        """
+        Write the buffered lines with a single write and empty the buffer
+        """
+        if out is None:
+            out = sys.stdout
+        data = self.render()
+        if data:
+            out.write(data)
+            out.flush()
+        self.lines = []
+
+
+class Instrumentation:
+    """
+    Per step measurements for instrumentation mode: wall time, time spent waiting on subprocesses/apis, the number of
+    bytes they returned for parsing and the growth in allocated blocks (live objects on pythons without
+    sys.getallocatedblocks). Io time is summed over the calls so it can exceed the wall time of a step which makes
+    calls in parallel. When a profile file is given every step is also run under cProfile and the combined
+    profile is written there at the end of the run.
+
+    There is a single instance, instrumentation, which the plugins enable from their config. Api and subprocess
+    calls report to it through io(), which costs nothing while it is disabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.profile_file = ''
+        self.steps = []         # [label, wall, io time, io calls, bytes, allocs] in the order the steps started
+        self.current = {}       # thread -> measurements of the step running in it
+        self.last = None        # measurements of the step started last, threads started by a step report to it
+        self.profiles = []
+        self.lock = None
+
+    def enable(self, profile_file=''):
+        if self.lock is None:
+            self.lock = threading.Lock()
+        self.enabled = True
+        self.profile_file = profile_file
+
+    def allocated(self):
+        if hasattr(sys, 'getallocatedblocks'):
+            return sys.getallocatedblocks()
+        return len(gc.get_objects())
+
+    def io(self, seconds, nbytes=0):
+        """
+        Record a subprocess or api call made by the step running in the calling thread
+        """
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            stats = self.current.get(threading.currentThread(), self.last)
+            if stats is not None:
+                stats[2] += seconds
+                stats[3] += 1
+                stats[4] += nbytes
+        finally:
+            self.lock.release()
+
+    def run(self, step):
+        """
+        Run a step, measuring it. The label is the step name, qualified by the name of the step's function when
+        several steps share a name.
+        """
+        stats = [step.name, 0.0, 0.0, 0, 0, 0]
+        thread = threading.currentThread()
+        self.lock.acquire()
+        try:
+            for other in self.steps:
+                if other[0] == step.name:
+                    stats[0] = step.name + "_" + getattr(step.target, '__name__', 'step')
+            self.steps.append(stats)
+            self.current[thread] = stats
+            self.last = stats
+        finally:
+            self.lock.release()
+        allocated = self.allocated()
+        started = time.time()
+        try:
+            if self.profile_file:
+                import cProfile
+                profile = cProfile.Profile()
+                self.profiles.append(profile)
+                return profile.runcall(step.target, *step.args)
+            return step.target(*step.args)
+        finally:
+            stats[1] = time.time() - started
+            stats[5] = self.allocated() - allocated
+            self.lock.acquire()
+            try:
+                del self.current[thread]
+            finally:
+                self.lock.release()
+
+    def report(self, output, checkname):
+        """
+        Add the <plugin>_self_monitoring line with the measurements of every step as perfdata and write the profile
+        """
+        if not self.enabled:
+            return
+        perfdata = []
+        wall = io = 0.0
+        nbytes = 0
+        for label, step_wall, step_io, calls, step_bytes, allocs in self.steps:
+            wall += step_wall
+            io += step_io
+            nbytes += step_bytes
+            perfdata.append("{0}_wall={1:.4f}|{0}_io={2:.4f}|{0}_io_calls={3}|{0}_bytes={4}|{0}_allocs={5}".format(
+                label, step_wall, step_io, calls, step_bytes, allocs))
+        perfdata.insert(0, "wall={0:.4f}|io={1:.4f}|bytes={2}".format(wall, io, nbytes))
+        description = "OK - {0} step(s) took {1:.3f}s, {2:.3f}s of it waiting on subprocesses/apis, {3} bytes " \
+                      "parsed".format(len(self.steps), wall, io, nbytes)
+        if self.profile_file and self.profiles:
+            try:
+                import pstats
+                stats = pstats.Stats(self.profiles[0])
+                for profile in self.profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(self.profile_file)
+                description += ", profile written to " + self.profile_file
+            except (IOError, OSError), e:
+                description += ", unable to write profile (" + str(e) + ")"
+        output.add(0, checkname, "|".join(perfdata), description)
+        self.steps = []
+        self.profiles = []
+
+
+instrumentation = Instrumentation()
+
+
+class Step:
+    """
+    A step started by TimeBudget.start, running in its own thread with its own output buffer.
+    """
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.output = OutputBuffer()
+        self.result = None
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.thread = None
+
+    def run(self):
+        try:
+            if instrumentation.enabled:
+                self.result = instrumentation.run(self)
+            else:
+                self.result = self.target(*self.args)
+        except Exception, e:
+            self.error = e
+        self.finished = time.time()
+
+
+class TimeBudget:
+    """
+    Runs the steps of a plugin within an overall time budget so a hung step costs its own services rather than the
+    whole output of the plugin when the agent kills it. Each step runs in a thread and buffers its own lines, a step
+    which has not finished when the budget (or its own timeout) runs out is abandoned and reported as UNKNOWN. Every
+    line gets the duration of the step which produced it as check_duration perfdata.
+
+    A budget of 0 disables the limit, steps then run in the calling thread.
+    """
+    def __init__(self, seconds=0, output=None):
+        self.seconds = float(seconds)
+        self.started = time.time()
+        if output is None:
+            output = OutputBuffer()
+        self.output = output
+        self.buffers = {}       # thread -> output buffer of the step running in it
+
+    def remaining(self):
+        """
+        :return : seconds left in the budget, None if there is no budget
+        """
+        if self.seconds <= 0:
+            return None
+        return max(0.0, self.started + self.seconds - time.time())
+
+    def add(self, status=0, checkname='', perfdata='-', description=''):
+        """
+        Add a line to the output of the step running in the calling thread, or straight to the output outside a step
+        """
+        self.buffer().add(status, checkname, perfdata, description)
+
+    def buffer(self):
+        """
+        :return : (OutputBuffer) the buffer add() writes to from the calling thread, for adding many lines in a loop
+        """
+        return self.buffers.get(threading.currentThread(), self.output)
+
+    def start(self, name, target, *args):
+        """
+        Start a step in its own thread, see wait(). Nothing is started once the budget is used up.
+
+        :param name   : service name the UNKNOWN line is reported under if the step does not finish
+        :param target : function to run, lines it adds through add() are kept until the step is waited for
+        :return       : (Step) the started step
+        """
+        step = Step(name, target, args)
+        if self.remaining() == 0:
+            return step
+        step.thread = threading.Thread(target=step.run)
+        step.thread.setDaemon(True)
+        self.buffers[step.thread] = step.output
+        step.thread.start()
+        return step
+
+    def wait(self, step, timeout=None):
+        """
+        Wait for a step to finish, for at most timeout seconds and never past the end of the budget. The output of a
+        finished step is added to the run output, a step which is still running is reported as UNKNOWN instead and
+        left to finish in the background.
+
+        :return : the return value of the step, None if it did not finish
+        """
+        limit = self.remaining()
+        if timeout is not None and (limit is None or timeout < limit):
+            limit = max(0.0, timeout)
+        if step.thread is not None:
+            step.thread.join(limit)
+        if step.thread is None:
+            self.output.add(3, step.name, "check_duration=0.000",
+                            "UNKNOWN - Not run, time budget of {0:.0f}s used up".format(self.seconds))
+            return None
+        if step.finished is None:
+            elapsed = time.time() - step.started
+            self.output.add(3, step.name, "check_duration={0:.3f}".format(elapsed),
+                            "UNKNOWN - Did not finish within {0:.0f}s, output skipped".format(elapsed))
+            return None
+        del self.buffers[step.thread]
+        return self.finish(step)
+
+    def run(self, name, target, *args):
+        """
+        Run a step and wait for it, see start() and wait()
+
+        :return : the return value of the step, None if it did not finish
+        """
+        if self.seconds > 0:
+            return self.wait(self.start(name, target, *args))
+        # no budget so no thread is needed, the step just gets its own buffer for the duration
+        step = Step(name, target, args)
+        current = threading.currentThread()
+        previous = self.buffers.get(current)
+        self.buffers[current] = step.output
+        try:
+            step.run()
+        finally:
+            if previous is None:
+                del self.buffers[current]
+            else:
+                self.buffers[current] = previous
+        return self.finish(step)
+
+    def finish(self, step):
+        if step.error is not None:
+            step.output.add(3, step.name, '-', "UNKNOWN - Failed (" + str(step.error) + ")")
+        step.output.add_duration(step.finished - step.started)
+        self.output.extend(step.output)
+        return step.result
@@ -5,49 +5,380 @@
 
    Version      Author          Date        Description
      0.1        Nigel Heaney    06-02-2018  Initial version
+     0.2                        18-10-2026  Keep-alive api client with timeouts, only decode the servers list
+     0.3                        18-10-2026  Poll several dnsdist instances concurrently from one config
+     0.4                        18-10-2026  Optional service per backend with thresholds
+     0.5                        18-10-2026  Shared output buffer and time budget from check_mk_common
+     0.6                        18-10-2026  Instrumentation mode
+     0.7                        18-10-2026  Lazy imports and a cached config parse for a fast start
+     0.8                        18-10-2026  Default pool reported as "default", servers key only read at top level
+     0.9                        18-10-2026  Latency window kept as fixed latency buckets per pool per run
+     0.10                       18-10-2026  Backend services told apart by name and address
+     0.11                       18-10-2026  Settings checked and converted when the config is loaded
 
 """
 import os
 import re
-import json
-import urllib2
+import copy
+import math
+import time
+from check_mk_common import OutputBuffer, TimeBudget, LazyModule, instrumentation, read_config
+# imported on first use, generating the config needs none of them
+json = LazyModule('json')
+socket = LazyModule('socket')
+tempfile = LazyModule('tempfile')
+httplib = LazyModule('httplib')
+urlparse = LazyModule('urlparse')
+
+
+class DnsdistAPI:
+    """
+    Client for the dnsdist REST API. One keep-alive connection is reused for every request, connecting and reading
+    are both bounded by timeouts so a hung dnsdist cannot block the agent, and responses can be decoded partially.
+    """
+    def __init__(self, url, api_key, connect_timeout=2, read_timeout=5):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme or 'http'
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.conn = None
+
+    def connect(self):
+        if self.scheme == 'https':
+            self.conn = httplib.HTTPSConnection(self.netloc, timeout=self.connect_timeout)
+        else:
+            self.conn = httplib.HTTPConnection(self.netloc, timeout=self.connect_timeout)
+        self.conn.connect()
+        self.conn.sock.settimeout(self.read_timeout)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, path=None):
+        """
+        GET a path from the api and return the raw body. A keep-alive connection which dnsdist has closed is
+        reopened once, timeouts and http errors are raised.
+
+        :param path : path (and query) to request, defaults to the path of the configured url
+        :return     : (str) the response body
+        """
+        if path is None:
+            path = self.path
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.connect()
+            started = time.time()
+            try:
+                self.conn.request('GET', path, headers={"X-API-Key": self.api_key})
+                response = self.conn.getresponse()
+                body = response.read()
+                instrumentation.io(time.time() - started, len(body))
+            except socket.timeout:
+                self.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt == 2:
+                    raise
+                continue
+            if response.status != 200:
+                raise IOError("HTTP " + str(response.status) + " " + str(response.reason) + " for " + path)
+            return body
+
+    def get_json(self, path=None, key=None):
+        """
+        GET a path and decode the json body. If key is given only the value of that top level key is decoded, the
+        rest of the (potentially multi MB) document such as rules and dynblocks is never turned into objects.
+
+        :param path : path (and query) to request, defaults to the path of the configured url
+        :param key  : top level key to extract
+        :return     : the decoded document, or value of key
+        """
+        body = self.get(path)
+        if key is None:
+            return json.loads(body)
+        return extract_json_key(body, key)
+
+
+def extract_json_key(body, key):
+    """
+    Decode only the value of a top level key from a json object held in body. Every occurrence of the quoted key is
+    tried until one is followed by a colon and a decodable value at the top level of the document, so a nested object
+    with a key of the same name is skipped. Falls back to decoding the whole document if the key cannot be located
+    this way.
+    """
+    decoder = json.JSONDecoder()
+    marker = '"' + key + '"'
+    depth = 0
+    scanned = 0
+    idx = body.find(marker)
+    while idx != -1:
+        if body[idx - 1:idx] == '\\':
+            # an escaped quote inside a string which happens to be followed by the key
+            idx = body.find(marker, idx + 1)
+            continue
+        # any other occurrence starts outside a string, so the depth can be carried from one to the next
+        depth += json_depth(body[scanned:idx])
+        scanned = idx
+        pos = idx + len(marker)
+        while pos < len(body) and body[pos] in ' \t\r\n':
+            pos += 1
+        if depth == 1 and pos < len(body) and body[pos] == ':':
+            pos += 1
+            while pos < len(body) and body[pos] in ' \t\r\n':
+                pos += 1
+            try:
+                return decoder.raw_decode(body, pos)[0]
+            except ValueError:
+                pass
+        idx = body.find(marker, idx + 1)
+    return json.loads(body)[key]
+
+
+def json_depth(text):
+    """
+    Return how many objects/arrays a piece of json opens minus how many it closes, ignoring brackets inside strings.
+    text has to start outside a string. Only string operations are used so skipping a large part of a document stays
+    cheap.
+    """
+    if '\\' in text:
+        # drop escaped backslashes and quotes so every quote left starts or ends a string
+        text = text.replace('\\\\', '').replace('\\"', '')
+    text = ''.join(text.split('"')[0::2])
+    return text.count('{') + text.count('[') - text.count('}') - text.count(']')
+
+
+def config_quoted(value):
+    return value.strip('"')
+
+
+def config_number(value):
+    """
+    Config value as an int, or a float if it has a fraction. Raises ValueError unless it is a number >= 0.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError("not a number")
+    if number < 0:
+        raise ValueError("must not be negative")
+    return number
+
+
+def config_integer(value):
+    """
+    Config value as an int >= 0, raises ValueError otherwise.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError("not a whole number")
+    if number < 0:
+        raise ValueError("must not be negative")
+    return number
+
+
+def check_threshold(value, warn, crit):
+    """
+    Return the check_mk status of value against warn/crit thresholds, a threshold of 0 is not checked
+    """
+    if crit and value >= crit:
+        return 2
+    if warn and value >= warn:
+        return 1
+    return 0
+
+
+# latency percentiles are kept as traffic per latency bucket, buckets are LATENCY_BUCKETS_PER_DOUBLING to every
+# doubling of the latency above LATENCY_BUCKET_MIN ms, about 9% wide
+LATENCY_BUCKET_MIN = 0.01
+LATENCY_BUCKETS_PER_DOUBLING = 8
+
+
+def latency_bucket(latency):
+    """
+    Return the bucket a latency (ms) falls in. Buckets are fixed, so the summary of a pool for a run is at most a
+    bucket per 9% of latency range however many backends the pool has.
+    """
+    if latency <= LATENCY_BUCKET_MIN:
+        return 0
+    return int(math.ceil(math.log(latency / LATENCY_BUCKET_MIN, 2) * LATENCY_BUCKETS_PER_DOUBLING))
+
+
+def bucket_latency(bucket):
+    """
+    Return the upper bound (ms) of a latency bucket, the lower bound is the upper bound of the bucket below
+    """
+    return LATENCY_BUCKET_MIN * 2 ** (float(bucket) / LATENCY_BUCKETS_PER_DOUBLING)
+
+
+def latency_percentiles(buckets, percentiles):
+    """
+    Return the latency at each of the given percentiles of a {latency bucket: [weight, samples]} summary, so a
+    backend taking most of the traffic counts for most of the distribution. Samples are weighted equally if there is
+    no traffic at all. A percentile is interpolated linearly within the bucket it falls in, so it is not rounded up
+    to the bucket bound.
+    """
+    if not buckets:
+        return [0.0] * len(percentiles)
+    ordered = sorted(buckets)
+    field = 0
+    total = sum([buckets[bucket][0] for bucket in ordered])
+    if total <= 0:
+        field = 1
+        total = sum([buckets[bucket][1] for bucket in ordered])
+    results = []
+    for percentile in percentiles:
+        threshold = total * percentile / 100.0
+        cumulative = 0
+        result = bucket_latency(ordered[-1])
+        for bucket in ordered:
+            weight = buckets[bucket][field]
+            if weight > 0 and cumulative + weight >= threshold:
+                lower = bucket_latency(bucket - 1) if bucket > 0 else 0.0
+                result = lower + (bucket_latency(bucket) - lower) * (threshold - cumulative) / float(weight)
+                break
+            cumulative += weight
+        results.append(result)
+    return results
 
 
 class check_mk_dnsdist:
+    # config file setting -> (attribute it sets, converter of the value, raising ValueError if it is invalid)
+    config_keys = {
+        'debug': ('debug', config_integer),
+        'url': ('apiurl', config_quoted),
+        'password': ('api_password', config_quoted),
+        'connect_timeout': ('connect_timeout', config_number),
+        'read_timeout': ('read_timeout', config_number),
+        'state_file': ('state_file', config_quoted),
+        'latency_window': ('latency_window', config_integer),
+        'up_threshold': ('up_threshold', config_integer),
+        'instance_timeout': ('instance_timeout', config_number),
+        'time_budget': ('time_budget', config_number),
+        'instrumentation': ('instrumentation', config_integer),
+        'profile_file': ('profile_file', config_quoted),
+        'per_backend': ('per_backend', config_integer),
+        'backend_latency_warn': ('backend_latency_warn', config_number),
+        'backend_latency_crit': ('backend_latency_crit', config_number),
+        'backend_outstanding_warn': ('backend_outstanding_warn', config_number),
+        'backend_outstanding_crit': ('backend_outstanding_crit', config_number),
+        'backend_drop_rate_warn': ('backend_drop_rate_warn', config_number),
+        'backend_drop_rate_crit': ('backend_drop_rate_crit', config_number),
+    }
+
     def __init__(self):
         self.apiurl = 'http://localhost:8080/api/v1/servers/localhost'
         self.api_password = 'secret'
-        self.headers = {"X-API-Key": self.api_password}
+        self.connect_timeout = 2        # seconds to establish a connection to the api
+        self.read_timeout = 5           # seconds to wait on the api for data
+        self.api = None
         self.data = {}
 
         self.up_threshold = 1           # number of servers up in ap pool to be considered ok
         self.debug = 0
+        self.config_cache = '/var/lib/check_mk_agent/check_mk_dnsdist.conf.cache'  # parsed config, until it changes
+
+        # instances from [name] sections in the config, each one is polled in its own thread and reported as
+        # dnsdist_<name>_* services. Without sections this object is the only instance and the names stay dnsdist_*
+        self.name = ''
+        self.prefix = 'dnsdist'
+        self.instances = []
+        self.instance_timeout = 10      # seconds an instance has to answer before it is reported as unknown
+
+        # output of the run, lines are added through the time budget of the run so each step buffers its own
+        self.time_budget = 50           # seconds the whole run has, a step still running then is reported as unknown
+        self.output = OutputBuffer()
+        self.budget = TimeBudget(0, self.output)
+        self.instrumentation = 0        # time every step and report it as dnsdist_self_monitoring
+        self.profile_file = ''          # write a cProfile dump of the steps here in instrumentation mode
+
+        # per backend counters from the previous run, used for true rates and the latency percentile window
+        self.state_file = '/var/lib/check_mk_agent/check_mk_dnsdist.state'
+        self.latency_window = 30        # number of runs kept for the latency percentiles
+
+        # optional service per backend, thresholds of 0 are not checked
+        self.per_backend = 0
+        self.backend_latency_warn = 0       # ms
+        self.backend_latency_crit = 0
+        self.backend_outstanding_warn = 0   # queries
+        self.backend_outstanding_crit = 0
+        self.backend_drop_rate_warn = 0     # drops per second
+        self.backend_drop_rate_crit = 0
+
+    def load_state(self):
+        """
+        Load the state saved by the previous run, an empty state is returned if there is none or it is unreadable.
 
-    def call_api(self, url, header):
+        :return : (dict) {'time': epoch, 'backends': {backend: [queries, drops]},
+                          'latency': {pool: [[[latency bucket, weight, samples],..] per run,..]}}
+        """
+        try:
+            statefile = open(self.state_file, 'r')
+            try:
+                state = json.load(statefile)
+            finally:
+                statefile.close()
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+    def save_state(self, state):
+        """
+        Save state for the next run, written to a temp file and renamed so a concurrent run never reads half a file.
+        """
+        directory = os.path.dirname(self.state_file)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp = tempfile.mkstemp(prefix='.check_mk_dnsdist', dir=directory)
+            statefile = os.fdopen(fd, 'w')
+            try:
+                # dumps rather than dump, only dumps uses the c encoder
+                statefile.write(json.dumps(state, separators=(',', ':')))
+            finally:
+                statefile.close()
+            os.rename(temp, self.state_file)
+        except (IOError, OSError) as e:
+            self.print_debug("Unable to save state to " + self.state_file + " (" + str(e) + ")")
+
+    def call_api(self, key='servers'):
         """
         Call dnsdist rest API to collect data on server pools/servers and stats
 
-        :param url    : url to access the api and path to collect the data
-        :param header : dictionary of headers we need to pass to the api
+        :param key    : top level key of the api document we need, only this part of the response is decoded
         :return       : (dict) the extracted json data as dictionary
         """
-        request = urllib2.Request(url, headers=header)
-        return json.load(urllib2.urlopen(request))
+        if self.api is None:
+            self.api = DnsdistAPI(self.apiurl, self.api_password, float(self.connect_timeout), float(self.read_timeout))
+        return {key: self.api.get_json(key=key)}
 
     def collect_data(self):
         """
         Collect the data we need to process and report on the availability of the api to omd
         """
         status = 0
-        checkname = 'dnsdist_api'
+        checkname = self.prefix + '_api'
         description = ''
         try:
-            self.data = self.call_api(self.apiurl, self.headers)
+            self.data = self.call_api('servers')
         except Exception as e:
             description = "WARN - API is not responding (" + str(e) + ")"
             status = 1
             self.print_output(status, checkname, "-", description)
-            exit(1)
+            return 0
 
         # All is good so we will report api as working
         description = "OK - API is responding"
@@ -66,130 +397,338 @@ class check_mk_dnsdist:
         checkname = ''
         description = ''
         perfdata = '-'
-        temp_list = []
-        pool_members = {}
-        # Lets extract all the pool names in the dataset.
-        for pool in self.data['servers']:
-            temp_list.append(pool['pools'][0])
-            pool_members[pool['pools'][0]] = []
-
-        # Lets collate a list of servers and what pool they belong to
+
+        # Backend counters from the previous run give true query/drop rates, and the traffic each backend took since
+        # then is the weight of its latency.
+        now = time.time()
+        previous = self.load_state()
+        previous_backends = previous.get('backends', {})
+        elapsed = now - previous.get('time', now)
+        backends = {}
+
+        # Single pass over the servers accumulating per pool totals. A server counts towards every pool it is a
+        # member of, servers without a pool (dnsdist reports "pools": []) belong to the default pool, reported as
+        # "default" so its perfdata and status have a label.
+        # accumulator layout: [qps, queries, weighted latency total, latency weight, outstanding, up, down,
+        #                      query delta, drop delta, {latency bucket: [weight, samples]}, latency total, samples]
+        pools = {}
+        per_backend = str(self.per_backend) == '1'
+        backend_rows = []
         for server in self.data['servers']:
-            pool_members[server['pools'][0]].append(server['name'])
-
-        # Now lets calculate qps per pool, num of queries, up status for the pool, latency and outstanding and Drops
-        perf_query = ""
-        perf_qps = ""
-        perf_latency = ""
-        perf_outstanding = ""
-        perf_status = ""
+            is_up = server['state'].lower() == "up"
+            qps = int(server['qps'])
+            queries = int(server['queries'])
+            drops = int(server.get('drops', 0))
+            # if a server is mark DOWN manually then dnsdist will set latency to Null so ignore if we detect this
+            latency = server['latency']
+            if latency is not None:
+                latency = float(latency)
+                bucket = latency_bucket(latency)
+            outstanding = int(server['outstanding'])
+
+            backend = str(server['name']) + '/' + str(server.get('address', ''))
+            backends[backend] = [queries, drops]
+            last = previous_backends.get(backend)
+            query_delta = drop_delta = 0
+            if elapsed > 0 and last is not None and queries >= last[0] and drops >= last[1]:
+                query_delta = queries - last[0]
+                drop_delta = drops - last[1]
+            # weight by traffic since the last run, or by current qps when there is no usable previous run
+            weight = query_delta if last is not None else qps
+            if per_backend:
+                backend_rows.append((str(server['name']), str(server.get('address', '')), is_up, qps, latency,
+                                     outstanding, drop_delta))
+
+            for pool in server['pools'] or ['default']:
+                if pool == '':
+                    pool = 'default'
+                acc = pools.get(pool)
+                if acc is None:
+                    acc = pools[pool] = [0, 0, 0.0, 0, 0, 0, 0, 0, 0, {}, 0.0, 0]
+                acc[0] += qps
+                acc[1] += queries
+                if latency is not None:
+                    acc[2] += latency * weight
+                    acc[3] += weight
+                    summary = acc[9].get(bucket)
+                    if summary is None:
+                        acc[9][bucket] = [weight, 1]
+                    else:
+                        summary[0] += weight
+                        summary[1] += 1
+                    acc[10] += latency
+                    acc[11] += 1
+                acc[4] += outstanding
+                if is_up:
+                    acc[5] += 1
+                else:
+                    acc[6] += 1
+                acc[7] += query_delta
+                acc[8] += drop_delta
+
+        # Now lets format qps per pool, num of queries, up status for the pool, latency and outstanding
+        perf_query = []
+        perf_qps = []
+        perf_latency = []
+        perf_latency_percentiles = []
+        perf_query_rate = []
+        perf_drop_rate = []
+        perf_outstanding = []
+        window = {}
+        previous_window = previous.get('latency', {})
+        latency_window = int(self.latency_window)
+        perf_status = []
         perf_status_crit = 0
-        perf_status_crit_details = ""
+        perf_status_crit_details = []
         perf_status_warn = 0
-        for pool in pool_members:
-            qps = []
-            queries = []
-            outstanding = []
-            latency = []
-            up = 0
-            down = 0
-            for server in self.data['servers']:
-                # for each server in the pool, gather stats
-                if server['name'] in pool_members[pool]:
-                    # Lets determine up/down status
-                    if server['state'].lower() == "up":
-                        up += 1
-                    else:
-                        down += 1
-
-                    # collate stats
-                    qps.append({server['name']: server['qps']})
-                    queries.append({server['name']: server['queries']})
-                    latency.append({server['name']: server['latency']})
-                    outstanding.append({server['name']: server['outstanding']})
-
+        for pool, acc in pools.iteritems():
+            pool = str(pool)
             # up/down status -
-            if down > 0:
+            if acc[6] > 0:
                 perf_status_warn += 1
-            if up == 0:
+            if acc[5] < int(self.up_threshold):
                 perf_status_crit += 1
-                perf_status_crit_details += str(pool) + "|"
-            perf_status += str(pool) + "=" + str(up) + "|"
+                perf_status_crit_details.append(pool)
+            perf_status.append(pool + "=" + str(acc[5]))
 
             # qps - output current queries per second
-            totalqps = 0
-            for item in qps:
-                numqps = item.values()
-                totalqps += int(numqps[0])
-            perf_qps += str(pool) + "=" + "{0:.3f}".format(totalqps, 2) + "|"
+            perf_qps.append(pool + "=" + "{0:.3f}".format(acc[0]))
 
             # queries check
-            totalqueries = 0
-            for item in queries:
-                numq = item.values()
-                totalqueries += int(numq[0])
-            perf_query += str(pool) + "=" + str(totalqueries) + "|"
-
-            # latency check
-            totallatency = 0
-            for item in latency:
-                lat = item.values()
-                # if a server is mark DOWN manually then dnsdist will set latency to Null so ig nore if we detect this
-                if lat[0] is not None:
-                    totallatency += float(lat[0])
-
-            # calculate av latency for the pool total/number of members
-            avg_latency = totallatency / len(latency)
-            perf_latency += str(pool) + "=" + "{0:.3f}".format(avg_latency, 3) + "|"
+            perf_query.append(pool + "=" + str(acc[1]))
+
+            # traffic weighted average latency of the members that report one
+            if acc[3] > 0:
+                avg_latency = acc[2] / acc[3]
+            elif acc[11]:
+                avg_latency = acc[10] / acc[11]
+            else:
+                avg_latency = 0.0
+            perf_latency.append(pool + "=" + "{0:.3f}".format(avg_latency))
+
+            # latency percentiles over the rolling window of runs, each run is kept as its latency buckets
+            runs = previous_window.get(pool, [])[1 - latency_window:] if latency_window > 1 else []
+            runs.append([[bucket, weight, count] for bucket, (weight, count) in acc[9].iteritems()])
+            window[pool] = runs
+            merged = {}
+            for run in runs:
+                for bucket, weight, count in run:
+                    summary = merged.get(bucket)
+                    if summary is None:
+                        merged[bucket] = [weight, count]
+                    else:
+                        summary[0] += weight
+                        summary[1] += count
+            for percentile, latency in zip((50, 95, 99), latency_percentiles(merged, (50, 95, 99))):
+                perf_latency_percentiles.append(pool + "_p" + str(percentile) + "=" + "{0:.3f}".format(latency))
+
+            # true query and drop rates from the counter deltas
+            rate_elapsed = elapsed if elapsed > 0 else 1
+            perf_query_rate.append(pool + "=" + "{0:.3f}".format(acc[7] / rate_elapsed))
+            perf_drop_rate.append(pool + "=" + "{0:.3f}".format(acc[8] / rate_elapsed))
 
             # outstanding - amount of pending requests
-            totaloutstanding = 0
-            for item in outstanding:
-                out = item.values()
-                totaloutstanding += int(out[0])
-            perf_outstanding += str(pool) + "=" + str(totaloutstanding) + "|"
+            perf_outstanding.append(pool + "=" + str(acc[4]))
+
+        perf_query = "|".join(perf_query)
+        perf_qps = "|".join(perf_qps)
+        perf_latency = "|".join(perf_latency)
+        perf_latency_percentiles = "|".join(perf_latency_percentiles)
+        perf_query_rate = "|".join(perf_query_rate)
+        perf_drop_rate = "|".join(perf_drop_rate)
+        self.save_state({'time': now, 'backends': backends, 'latency': window})
+        perf_outstanding = "|".join(perf_outstanding)
+        perf_status = "|".join(perf_status)
 
         # Output summary level stats to keeps things tidy
         # qps
         status = 0
-        checkname = "dnsdist_qps"
+        checkname = self.prefix + "_qps"
         description = "OK - Current Queries per second (QPS) "
-        self.print_output(status, checkname, perf_qps[:-1], description)
+        self.print_output(status, checkname, perf_qps, description)
 
         # queries
-        checkname = "dnsdist_queries"
+        checkname = self.prefix + "_queries"
         description = "OK - Total queries performed"
-        self.print_output(status, checkname, perf_query[:-1], description)
+        self.print_output(status, checkname, perf_query, description)
 
         # latency
-        checkname = "dnsdist_latency"
-        description = "OK - Average Latency per pool "
-        self.print_output(status, checkname, perf_latency[:-1], description)
+        checkname = self.prefix + "_latency"
+        description = "OK - Average Latency per pool (weighted by traffic)"
+        self.print_output(status, checkname, perf_latency, description)
+
+        checkname = self.prefix + "_latency_percentiles"
+        description = "OK - Latency p50/p95/p99 per pool over the last " + str(self.latency_window) + " runs"
+        self.print_output(status, checkname, perf_latency_percentiles, description)
+
+        # rates from counters
+        if elapsed > 0:
+            note = ""
+        else:
+            note = " (rates available from next run)"
+        checkname = self.prefix + "_query_rate"
+        description = "OK - Queries per second per pool since last run" + note
+        self.print_output(status, checkname, perf_query_rate, description)
+
+        checkname = self.prefix + "_drop_rate"
+        description = "OK - Drops per second per pool since last run" + note
+        self.print_output(status, checkname, perf_drop_rate, description)
 
         # outstanding
-        checkname = "dnsdist_outstanding"
+        checkname = self.prefix + "_outstanding"
         description = "OK - Outstanding queries per pool "
-        self.print_output(status, checkname, perf_outstanding[:-1], description)
+        self.print_output(status, checkname, perf_outstanding, description)
 
         # Pool status
-        checkname = "dnsdist_pool_status"
+        checkname = self.prefix + "_pool_status"
         # If we have crit more than 0 then have servers pools which are completely offline so create an alert
         if perf_status_crit > 0:
             description = "CRIT - " + str(perf_status_crit) + " pool(s) DOWN! (" + \
-                          perf_status_crit_details.replace("|", ",")[:-1] + ")"
+                          ",".join(perf_status_crit_details) + ")"
             status = 2
         elif perf_status_warn > 0:
             description = "WARN - " + str(perf_status_warn) + " pool(s) have servers down"
             status = 1
         else:
             description = "OK - Server pools are healthy"
-        self.print_output(status, checkname, perf_status[:-1], description)
+        self.print_output(status, checkname, perf_status, description)
+
+        if per_backend:
+            self.backend_output(backend_rows, elapsed if elapsed > 0 else 0)
+
+    def backend_output(self, backend_rows, elapsed):
+        """
+        Output a service per backend with its state, qps, latency, outstanding queries and drop rate. There can be
+        hundreds of backends so thresholds are converted once and the perfdata is rendered with one format call.
+
+        :param backend_rows : list of (name, address, is_up, qps, latency, outstanding, drop delta) tuples
+        :param elapsed      : seconds since the previous run, 0 if there is none so no drop rate is known yet
+        """
+        latency_warn = float(self.backend_latency_warn)
+        latency_crit = float(self.backend_latency_crit)
+        outstanding_warn = float(self.backend_outstanding_warn)
+        outstanding_crit = float(self.backend_outstanding_crit)
+        drop_warn = float(self.backend_drop_rate_warn)
+        drop_crit = float(self.backend_drop_rate_crit)
+        # warn/crit fields of the perfdata as configured, left empty when the threshold is not checked
+        def levels(warn, crit):
+            return ";" + (float(warn) and str(warn) or "") + ";" + (float(crit) and str(crit) or "")
+        latency_levels = levels(self.backend_latency_warn, self.backend_latency_crit)
+        outstanding_levels = levels(self.backend_outstanding_warn, self.backend_outstanding_crit)
+        drop_levels = levels(self.backend_drop_rate_warn, self.backend_drop_rate_crit)
+        perfdata = "qps={0:.3f}|latency={1:.3f}" + latency_levels + "|outstanding={2}" + outstanding_levels + \
+                   "|drop_rate={3:.3f}" + drop_levels
+        checkname = self.prefix + "_backend_"
+        labels = ('OK', 'WARN', 'CRIT')
+
+        # a backend is its name and address, as in the state file. The service is named after the backend name, if
+        # different backends share a service name (same name, or names alike once sanitised) the address is added to
+        # it so none is dropped
+        identities = {}
+        for row in backend_rows:
+            identities.setdefault(re.sub('[^A-Za-z0-9_.-]', '_', row[0] or row[1]), set()).add(row[:2])
+        done = {}
+        seen = {}
+        for name, address, is_up, qps, latency, outstanding, drop_delta in backend_rows:
+            identity = (name, address)
+            if identity in done:
+                continue    # the same backend listed twice, one service is enough
+            done[identity] = 1
+            name = re.sub('[^A-Za-z0-9_.-]', '_', name or address)
+            if len(identities[name]) > 1:
+                name += '_' + re.sub('[^A-Za-z0-9_.-]', '_', address)
+            # names which still clash (alike once sanitised, same address) are numbered in order
+            suffix = 1
+            unique = name
+            while unique in seen:
+                suffix += 1
+                unique = name + '_' + str(suffix)
+            seen[unique] = 1
+            name = unique
+            drop_rate = drop_delta / elapsed if elapsed else 0.0
+            if latency is None:
+                latency = 0.0
+
+            if not is_up:
+                status = 2
+                problems = ["backend is DOWN"]
+            else:
+                status = 0
+                problems = []
+                for value, warn, crit, text in ((latency, latency_warn, latency_crit, "latency {0:.3f}ms"),
+                                                (outstanding, outstanding_warn, outstanding_crit, "{0} outstanding"),
+                                                (drop_rate, drop_warn, drop_crit, "{0:.3f} drops/s")):
+                    state = check_threshold(value, warn, crit)
+                    if state:
+                        status = max(status, state)
+                        problems.append(text.format(value))
+            if problems:
+                description = labels[status] + " - " + ", ".join(problems)
+            else:
+                description = "OK - backend is up"
+            self.print_output(status, checkname + name, perfdata.format(qps, latency, outstanding, drop_rate),
+                              description)
+
+    def check(self):
+        """
+        Collect and process one instance
+        """
+        try:
+            if self.collect_data():
+                self.process_data()
+        finally:
+            if self.api is not None:
+                self.api.close()
+
+    def run(self):
+        """
+        Check every instance within the time budget and print the output with a single write. Instances are polled
+        concurrently, an instance which has not finished within its instance_timeout or the time budget, or which
+        fails, is reported as unknown and does not hold up the others.
+        """
+        if str(self.instrumentation) == '1':
+            instrumentation.enable(self.profile_file)
+        self.budget = TimeBudget(self.time_budget, self.output)
+        if not self.instances:
+            if self.budget.run(self.prefix + '_api', self.collect_data):
+                self.budget.run(self.prefix + '_pool_status', self.process_data)
+            if self.api is not None:
+                self.api.close()
+        else:
+            steps = []
+            for instance in self.instances:
+                instance.budget = self.budget
+                steps.append(self.budget.start(instance.prefix + '_api', instance.check))
+            for instance, step in zip(self.instances, steps):
+                self.budget.wait(step, step.started + float(instance.instance_timeout) - time.time())
+        instrumentation.report(self.output, 'dnsdist_self_monitoring')
+        self.output.flush()
 
     def print_output(self, status=0, checkname='', perfdata='-', description=''):
         """
-        Print correctly formatted output for check_mk
+        Add a correctly formatted line of output for check_mk to the output of the step running
         """
-        print "{0} {1} {2} {3}".format(status, checkname, perfdata, description)
+        self.budget.add(status, checkname, perfdata, description)
+
+    def add_instance(self, name):
+        """
+        Start a new instance from a [name] section of the config. It inherits every setting made before the first
+        section and keeps its state in its own file.
+
+        :param name : name of the instance, used in the service names
+        :return     : the new instance
+        """
+        instance = copy.copy(self)
+        instance.name = re.sub('[^A-Za-z0-9_.-]', '_', name)
+        instance.prefix = 'dnsdist_' + instance.name
+        instance.instances = []
+        instance.output = OutputBuffer()
+        instance.budget = TimeBudget(0, instance.output)
+        instance.api = None
+        root, ext = os.path.splitext(self.state_file)
+        instance.state_file = root + '_' + instance.name + ext
+        self.instances.append(instance)
+        return instance
 
     def print_debug(self, message=''):
         """
@@ -204,30 +743,35 @@ class check_mk_dnsdist:
         Load a config file which will allow parameters to be stored outside of the script and will contain list of
         containers to watch, thresholds etc. If this file is missing then it will generate a default config which
         can then be customised by admins
+
+        Settings before the first [name] section are defaults, each [name] section adds an instance which can
+        override any of them.
         """
 
         # Check if config exists, if not create one and exit silently unless debug is enabled
         if os.path.isfile(configfile):
-            conffile = open(configfile, 'r')
-            conf = conffile.readlines()
-            conffile.close()
-            for line in conf:
-                if re.search('^#', line):
-                    continue  # comments
-                if line == '':
-                    continue  # ignore empty lines
-                # parameters
-                if 'debug=' in line:
-                    self.debug = re.sub('^.*=', '', line.rstrip())
-                if 'url=' in line:
-                    self.apiurl = re.sub('^.*=', '', line.rstrip())
-                if 'password=' in line:
-                    self.api_password = re.sub('^.*=', '', line.rstrip())
-                # More later
+            target = self
+            for key, value in read_config(configfile, self.config_cache):
+                # instance sections
+                if key == '[':
+                    target = self.add_instance(value)
+                elif key in self.config_keys:
+                    target.load_setting(key, value)
         else:
-            self.generate_config()
+            self.generate_config(configfile)
             exit(1)
 
+    def load_setting(self, key, value):
+        """
+        Apply a single key=value setting of the config to this instance. An invalid value is ignored in favour of the
+        default (or the value inherited from before the first section) so one typo does not stop the whole plugin.
+        """
+        attribute, convert = self.config_keys[key]
+        try:
+            setattr(self, attribute, convert(value))
+        except ValueError as e:
+            self.print_debug("Ignored {0}={1} ({2}), using {3}".format(key, value.strip(), e, getattr(self, attribute)))
+
     def generate_config(self, configfile="/etc/check_mk/check_mk_dnsdist.conf"):
         """
         Generate a default config file which can be customised by an admin.
@@ -238,13 +782,58 @@ class check_mk_dnsdist:
         conffile.write('#\n')
         conffile.write('debug=0\n')
         conffile.write('#url="http://localhost:8080/api/v1/servers/localhost"\n')
+        conffile.write('#password="aPassword"\n')
+        conffile.write('# seconds allowed to connect to and read from the api before it is reported as down\n')
+        conffile.write('connect_timeout=2\n')
+        conffile.write('read_timeout=5\n')
+        conffile.write('# per backend counters are kept here between runs for rates and latency percentiles\n')
+        conffile.write('state_file=/var/lib/check_mk_agent/check_mk_dnsdist.state\n')
+        conffile.write('# number of runs the latency percentiles are calculated over\n')
+        conffile.write('latency_window=30\n')
+        conffile.write('# number of servers which have to be up in a pool, fewer is critical\n')
+        conffile.write('up_threshold=1\n')
+        conffile.write('# seconds an instance has to answer before it is reported as unknown\n')
+        conffile.write('instance_timeout=10\n')
+        conffile.write('# seconds the whole run has before anything still running is reported as unknown, 0 disables\n')
+        conffile.write('time_budget=50\n')
+        conffile.write('# set instrumentation=1 to time every step, reported as dnsdist_self_monitoring, and\n')
+        conffile.write('# profile_file to also write a cProfile dump there\n')
+        conffile.write('instrumentation=0\n')
+        conffile.write('profile_file=\n')
+        conffile.write('# set per_backend=1 for a service per backend, thresholds of 0 are not checked\n')
+        conffile.write('per_backend=0\n')
+        conffile.write('backend_latency_warn=0\n')
+        conffile.write('backend_latency_crit=0\n')
+        conffile.write('backend_outstanding_warn=0\n')
+        conffile.write('backend_outstanding_crit=0\n')
+        conffile.write('backend_drop_rate_warn=0\n')
+        conffile.write('backend_drop_rate_crit=0\n')
+        conffile.write('#\n')
+        conffile.write('# Several dnsdist instances can be monitored by adding a section per instance, the settings\n')
+        conffile.write('# above are defaults which a section can override. Services are named dnsdist_<instance>_*\n')
+        conffile.write('#[vip1]\n')
+        conffile.write('#url="http://127.0.0.1:8081/api/v1/servers/localhost"\n')
         conffile.write('#password="aPassword"\n\n')
         conffile.close()
         os.chmod(configfile, 0755)
 
 
-if __name__ == "__main__":
+def main():
+    """
+    Run the check. The agent runs this through the check_mk_dnsdist executable so the bytecode of this module is
+    cached instead of compiled on every run. The config is read from MK_CONFDIR and cached in MK_VARDIR when the agent
+    exports them.
+    """
     check = check_mk_dnsdist()
-    check.load_config()
-    if check.collect_data():
-        check.process_data()
+    check.config_cache = os.path.join(os.environ.get('MK_VARDIR', '/var/lib/check_mk_agent'),
+                                      'check_mk_dnsdist.conf.cache')
+    check.load_config(os.path.join(os.environ.get('MK_CONFDIR', '/etc/check_mk'), 'check_mk_dnsdist.conf'))
+    check.run()
+
+
+if __name__ == "__main__":
+    # run as a script, the way installs from before the check_mk_dnsdist executable still run it. Where the agent has
+    # the executable next to this file it runs that as well, so the check is left to it rather than reported twice.
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_mk_dnsdist')
+    if 'MK_CONFDIR' not in os.environ or not os.access(wrapper, os.X_OK):
+        main()
@@ -4,15 +4,864 @@
                 
    Version      Author          Date        Description      
      0.1        Nigel Heaney    08-11-2015  Initial version
+     0.2                        18-10-2026  Talk to the docker engine api over its unix socket instead of the docker cli
+     0.3                        18-10-2026  Shared output buffer and time budget from check_mk_common
+     0.4                        18-10-2026  Instrumentation mode
+     0.5                        18-10-2026  Lazy imports and a cached config parse for a fast start
+     0.6                        18-10-2026  Typed and validated settings, per container threshold overrides
+     0.7                        18-10-2026  Compact container samples, single regex docker stats parser, SI/IEC units
                                             
     
 """
 import os
+import sys
 import time
 import re
+import fnmatch
+import traceback
+from check_mk_common import OutputBuffer, TimeBudget, LazyModule, instrumentation, read_config
+#Imported on first use, a run answered from the spool never needs them
+json = LazyModule('json')
+socket = LazyModule('socket')
+httplib = LazyModule('httplib')
+urllib = LazyModule('urllib')
+threading = LazyModule('threading')
+subprocess = LazyModule('subprocess')
+tempfile = LazyModule('tempfile')
+Queue = LazyModule('Queue')
+
+
+class DockerAPIError(Exception):
+    '''Raised when the docker engine api cannot be reached or returns an unexpected response.
+    '''
+    pass
+
+
+class DockerTimeout(DockerAPIError):
+    '''Raised when docker does not answer within the allowed time.
+    '''
+    pass
+
+
+UnixHTTPConnectionClass = None
+
+def UnixHTTPConnection(socketpath, timeout=30):
+    '''Return an HTTPConnection which connects to a unix domain socket rather than a tcp port, this is how dockerd
+       exposes its api. The class is built on first use as it needs httplib.
+    '''
+    global UnixHTTPConnectionClass
+    if UnixHTTPConnectionClass is None:
+        class UnixHTTPConnectionClass(httplib.HTTPConnection):
+            def __init__(self, socketpath, timeout=30):
+                httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+                self.socketpath = socketpath
+
+            def connect(self):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(self.socketpath)
+                self.sock = sock
+    return UnixHTTPConnectionClass(socketpath, timeout)
+
+
+class DockerAPI():
+    '''Minimal docker engine api client. A single HTTP/1.1 connection to the docker socket is opened on first use and
+       reused for every call so a poll costs one connect instead of forking the docker cli for each command.
+    '''
+    def __init__(self, socketpath='/var/run/docker.sock', timeout=30):
+        self.socketpath = socketpath
+        self.timeout = timeout
+        self.conn = None
+
+    def Available(self):
+        '''Return True if the docker socket exists and answers a ping.
+        '''
+        if not os.path.exists(self.socketpath): return False
+        try:
+            self.Request('/_ping', decode=False)
+        except DockerAPIError:
+            return False
+        return True
+
+    def Close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def Request(self, path, decode=True):
+        '''GET a path from the api and return the decoded json body. If dockerd has dropped our idle keep-alive
+           connection we reconnect once and retry, anything else is raised as a DockerAPIError.
+        '''
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = UnixHTTPConnection(self.socketpath, self.timeout)
+            started = time.time()
+            try:
+                self.conn.request('GET', path)
+                response = self.conn.getresponse()
+                body = response.read()
+                instrumentation.io(time.time() - started, len(body))
+            except socket.timeout, e:
+                self.Close()
+                raise DockerTimeout("Timed out calling " + path)
+            except (httplib.HTTPException, socket.error), e:
+                self.Close()
+                if attempt == 2: raise DockerAPIError("Error calling " + path + " (" + str(e) + ")")
+                continue
+            if response.status != 200:
+                raise DockerAPIError("Docker api returned " + str(response.status) + " for " + path)
+            if not decode: return body
+            try:
+                return json.loads(body)
+            except ValueError:
+                raise DockerAPIError("Docker api returned invalid json for " + path)
+
+    def Clone(self, timeout=None):
+        '''Return a new client for the same socket with its own connection, used to give each worker thread a connection.
+        '''
+        if timeout is None: timeout = self.timeout
+        return DockerAPI(self.socketpath, timeout)
+
+    def Containers(self):
+        '''Return a list of running containers as {'id': full id, 'name': container name}
+        '''
+        containers = []
+        for c in self.Request('/containers/json'):
+            name = c['Id'][:12]
+            if c.get('Names'): name = c['Names'][0].lstrip('/')
+            containers.append({'id': c['Id'], 'name': name})
+        return containers
+
+    def Stats(self, container):
+        '''Return a single stats sample for a container as a ContainerSample, cpu and mem in %, memused/memtotal in bytes.
+           Calculations follow the docker cli so the numbers match what "docker stats" would have shown.
+        '''
+        s = self.Request('/containers/' + container['id'] + '/stats?stream=false')
+        cpu = 0.0
+        cpustats = s.get('cpu_stats', {})
+        precpustats = s.get('precpu_stats', {})
+        cpudelta = cpustats.get('cpu_usage', {}).get('total_usage', 0) - precpustats.get('cpu_usage', {}).get('total_usage', 0)
+        systemdelta = cpustats.get('system_cpu_usage', 0) - precpustats.get('system_cpu_usage', 0)
+        ncpu = cpustats.get('online_cpus') or len(cpustats.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+        if cpudelta > 0 and systemdelta > 0:
+            cpu = round(float(cpudelta) / systemdelta * ncpu * 100.0, 2)
+
+        memused, memtotal = self.MemoryUsage(s)
+        mem = 0.0
+        if memtotal > 0: mem = round(100.0 * memused / memtotal, 2)
+        return ContainerSample(container['name'], cpu, mem, memused, memtotal)
+
+    def Counters(self, container):
+        '''Return the raw cumulative counters of a container (see StateFile) without waiting for a second cpu sample.
+        '''
+        s = self.Request('/containers/' + container['id'] + '/stats?stream=false&one-shot=true')
+        cpustats = s.get('cpu_stats', {})
+        memused, memtotal = self.MemoryUsage(s)
+        netin = netout = blkread = blkwrite = 0
+        for n in (s.get('networks') or {}).values():
+            netin += n.get('rx_bytes', 0)
+            netout += n.get('tx_bytes', 0)
+        for b in s.get('blkio_stats', {}).get('io_service_bytes_recursive') or []:
+            if b.get('op', '').lower() == 'read': blkread += b.get('value', 0)
+            if b.get('op', '').lower() == 'write': blkwrite += b.get('value', 0)
+        return {'id': container['id'], 'name': container['name'], 'time': time.time(),
+                'cpu': cpustats.get('cpu_usage', {}).get('total_usage', 0),
+                'system': cpustats.get('system_cpu_usage', 0),
+                'ncpu': cpustats.get('online_cpus') or len(cpustats.get('cpu_usage', {}).get('percpu_usage') or []) or 1,
+                'memused': memused, 'memtotal': memtotal,
+                'netin': netin, 'netout': netout, 'blkread': blkread, 'blkwrite': blkwrite}
+
+    def Events(self, since=None):
+        '''Generator yielding container events (start, die, destroy...) as dockerd publishes them. The stream never
+           ends so it gets a dedicated connection rather than the shared keep-alive one.
+        '''
+        path = '/events?filters=' + urllib.quote(json.dumps({'type': ['container']}))
+        if since is not None: path += '&since=' + str(int(since))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socketpath)
+            sock.sendall('GET ' + path + ' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            f = sock.makefile('rb')
+            status = f.readline().split()
+            if len(status) < 2 or status[1] != '200':
+                raise DockerAPIError("Docker api returned " + ' '.join(status[1:]) + " for /events")
+            chunked = False
+            while True:
+                l = f.readline()
+                if l in ['\r\n', '\n', '']: break
+                if l.lower().startswith('transfer-encoding:') and 'chunked' in l.lower(): chunked = True
+
+            buf = ''
+            while True:
+                if chunked:
+                    size = f.readline()
+                    if size == '' or int(size.split(';')[0], 16) == 0: return
+                    data = f.read(int(size.split(';')[0], 16))
+                    f.readline()
+                else:
+                    data = f.readline()
+                    if data == '': return
+                buf += data
+                while '\n' in buf:
+                    l, buf = buf.split('\n', 1)
+                    if l.strip() == '': continue
+                    try:
+                        yield json.loads(l)
+                    except ValueError:
+                        raise DockerAPIError("Docker api returned invalid json for /events")
+        except socket.error, e:
+            raise DockerAPIError("Error reading /events (" + str(e) + ")")
+        finally:
+            sock.close()
+
+    def MemoryUsage(self, s):
+        '''Return (used, limit) in bytes from a stats document
+        '''
+        memstats = s.get('memory_stats', {})
+        #docker excludes the page cache from the usage figure, v1 reports it as cache and v2 as inactive_file
+        memused = memstats.get('usage', 0) - memstats.get('stats', {}).get('cache', memstats.get('stats', {}).get('inactive_file', 0))
+        return int(memused), int(memstats.get('limit', 0))
+
+    def Info(self):
+        '''Return docker info as {'MemTotal': bytes, 'Driver': storage driver, 'DriverStatus': {name: value}}
+        '''
+        info = self.Request('/info')
+        driverstatus = {}
+        for k, v in info.get('DriverStatus') or []:
+            driverstatus[k] = v
+        return {'MemTotal': int(info.get('MemTotal', 0)), 'Driver': info.get('Driver', ''), 'DriverStatus': driverstatus}
+
+
+class DockerCLI():
+    '''Fallback for hosts where the docker socket is not reachable. Exposes the same records as DockerAPI but gathers
+       them by parsing docker cli output. Every command goes through Run so recorded output can be replayed.
+    '''
+    def __init__(self, dockerbin='/usr/bin/docker', friendlynames=True, timeout=None):
+        self.dockerbin = dockerbin
+        self.friendlynames = friendlynames
+        self.timeout = timeout
+
+    def Containers(self):
+        '''Return a list of running containers as {'id': full id, 'name': container name}
+        '''
+        containers = []
+        if self.friendlynames:
+            output = self.Run(['ps', '--no-trunc', '--format', '{{.ID}}\t{{.Names}}'])
+        else:
+            output = self.Run(['ps', '--no-trunc'])
+        for l in output.split('\n'):
+            if "CONTAINER ID" in l: continue        #ignore the header 
+            if l.strip() == '': continue            #ignore empty lines
+            columns = re.split('\t|  +', l.strip())
+            containers.append({'id': columns[0], 'name': columns[-1]})
+        return containers
+
+    def Clone(self, timeout=None):
+        '''Return a copy of this client which kills any docker command running longer than timeout.
+        '''
+        if timeout is None: timeout = self.timeout
+        return DockerCLI(self.dockerbin, self.friendlynames, timeout)
+
+    def Run(self, args, timeout=None):
+        '''Run the docker cli and return its output. If a timeout is given the command is killed once it expires and
+           DockerTimeout is raised.
+        '''
+        started = time.time()
+        proc = subprocess.Popen([self.dockerbin] + args, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, proc.kill)
+            timer.start()
+        output = proc.communicate()[0]
+        instrumentation.io(time.time() - started, len(output))
+        if timer is not None:
+            timer.cancel()
+            if proc.returncode == -9: raise DockerTimeout("Timed out running docker " + args[0])
+        return output
+
+    def Stats(self, container):
+        '''Return a single stats record for a container, same layout as DockerAPI.Stats
+        '''
+        stats = self.StatsAll([container])
+        if stats == []: raise DockerAPIError("No stats returned for " + container['name'])
+        return stats[0]
+
+    #One row of docker stats --no-stream: name, cpu %, memory usage / limit and memory %. Docker is inconsistent
+    #between versions, 17.06 and later print the container id before the name, the usage/limit separator comes with
+    #and without spaces ("1.2MiB / 2GiB", "1.2 MiB/2 GiB") and cpu/memory % show as -- while a container starts or
+    #stops. The header, rows without memory figures (a container being removed) and anything else which does not
+    #look like a row do not match.
+    StatsRow = re.compile(r'^(?:[0-9a-f]{12,64}[ \t]+)?(\S+)[ \t]+([0-9.]+%|--)[ \t]+([0-9.]+) ?([A-Za-z]*)[ \t]*/[ \t]*'
+                          r'([0-9.]+) ?([A-Za-z]*)[ \t]+([0-9.]+%|--)', re.M)
+
+    def StatsAll(self, containers):
+        '''Return one stats record per container. The cli samples all of them in one call.
+        '''
+        stats = []
+        if containers == []: return stats
+        container_stats = self.Run(["stats", "--no-stream=true"] + [c['name'] for c in containers], self.timeout)
+        units = Units
+        for name, cpu, used, usedunit, limit, limitunit, mem in self.StatsRow.findall(container_stats):
+            if cpu == '--': cpu = 0.0
+            else: cpu = float(cpu[:-1])
+            if mem == '--': mem = 0.0
+            else: mem = float(mem[:-1])
+            stats.append(ContainerSample(name, cpu, mem, int(float(used) * units.get(usedunit, 1)),
+                                         int(float(limit) * units.get(limitunit, 1))))
+        return stats
+
+    def Info(self):
+        '''Return docker info as {'MemTotal': bytes, 'Driver': storage driver, 'DriverStatus': {name: value}}
+        '''
+        memtotal = 0
+        driverstatus = {}
+        for l in self.Run(['info']).split('\n'):
+            if ': ' not in l: continue
+            k, v = l.strip().split(': ', 1)
+            driverstatus[k] = v
+            if k == 'Total Memory':
+                temp1, temp2 = re.split(' ', v)
+                memtotal = int(ConvertMetric(value=temp1, metric=temp2))
+        return {'MemTotal': memtotal, 'Driver': driverstatus.get('Storage Driver', ''), 'DriverStatus': driverstatus}
+
+
+class CgroupStats():
+    '''Read container cpu and memory usage straight from the cgroup filesystem (v1 or v2) without involving dockerd.
+       Produces the same records as DockerAPI.Stats so the rest of the plugin does not care where they came from.
+    '''
+    def __init__(self, root='/sys/fs/cgroup', interval=1.0, meminfo='/proc/meminfo', proc='/proc'):
+        self.root = root
+        self.interval = interval                            #Seconds between the two cpu samples
+        self.meminfo = meminfo
+        self.proc = proc
+        self.unified = os.path.isfile(os.path.join(root, 'cgroup.controllers'))
+        self.hostmem = None
+
+    def ReadFile(self, path):
+        started = time.time()
+        f = open(path, 'r')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        instrumentation.io(time.time() - started, len(data))
+        return data
+
+    def ReadStat(self, path):
+        '''Parse a "key value" per line file such as memory.stat or cpu.stat into a dict of ints
+        '''
+        stat = {}
+        for l in self.ReadFile(path).split('\n'):
+            kv = l.split()
+            if len(kv) == 2 and kv[1].isdigit(): stat[kv[0]] = int(kv[1])
+        return stat
+
+    def FindDir(self, controller, cid):
+        '''Locate the cgroup directory of a container, covering both the cgroupfs and systemd cgroup drivers.
+        '''
+        if self.unified:
+            controllers = ['']
+        elif controller == 'cpu':
+            controllers = ['cpuacct', 'cpu,cpuacct', 'cpuacct,cpu']
+        else:
+            controllers = [controller]
+        for c in controllers:
+            for d in [os.path.join('docker', cid), os.path.join('system.slice', 'docker-' + cid + '.scope')]:
+                path = os.path.join(self.root, c, d)
+                if os.path.isdir(path): return path
+        return None
+
+    def HostMemory(self):
+        '''Total host memory in bytes, used as the limit of containers that have none.
+        '''
+        if self.hostmem is None:
+            self.hostmem = 0
+            for l in self.ReadFile(self.meminfo).split('\n'):
+                if l.startswith('MemTotal:'): self.hostmem = int(l.split()[1]) * 1024
+        return self.hostmem
+
+    def CPUUsage(self, cid):
+        '''Cumulative cpu time used by a container in nanoseconds
+        '''
+        path = self.FindDir('cpu', cid)
+        if path is None: raise IOError("No cpu cgroup found for " + cid)
+        if self.unified:
+            return self.ReadStat(os.path.join(path, 'cpu.stat'))['usage_usec'] * 1000
+        return int(self.ReadFile(os.path.join(path, 'cpuacct.usage')))
+
+    def Memory(self, cid):
+        '''Return (used, limit) in bytes, with the page cache excluded from used the same way docker does.
+        '''
+        path = self.FindDir('memory', cid)
+        if path is None: raise IOError("No memory cgroup found for " + cid)
+        if self.unified:
+            used = int(self.ReadFile(os.path.join(path, 'memory.current')))
+            used -= self.ReadStat(os.path.join(path, 'memory.stat')).get('inactive_file', 0)
+            limit = self.ReadFile(os.path.join(path, 'memory.max')).strip()
+        else:
+            used = int(self.ReadFile(os.path.join(path, 'memory.usage_in_bytes')))
+            used -= self.ReadStat(os.path.join(path, 'memory.stat')).get('cache', 0)
+            limit = self.ReadFile(os.path.join(path, 'memory.limit_in_bytes')).strip()
+        hostmem = self.HostMemory()
+        if limit == 'max' or (hostmem > 0 and int(limit) > hostmem):
+            #unlimited, docker reports the host memory in this case
+            limit = hostmem
+        return max(used, 0), int(limit)
+
+    def BlockIO(self, cid):
+        '''Return cumulative (read, write) bytes for a container
+        '''
+        read = write = 0
+        if self.unified:
+            path = self.FindDir('io', cid)
+            if path is None: return 0, 0
+            for l in self.ReadFile(os.path.join(path, 'io.stat')).split('\n'):
+                for field in l.split()[1:]:
+                    k, v = field.split('=', 1)
+                    if k == 'rbytes': read += int(v)
+                    if k == 'wbytes': write += int(v)
+        else:
+            path = self.FindDir('blkio', cid)
+            if path is None: return 0, 0
+            for l in self.ReadFile(os.path.join(path, 'blkio.throttle.io_service_bytes')).split('\n'):
+                f = l.split()
+                if len(f) != 3: continue
+                if f[1] == 'Read': read += int(f[2])
+                if f[1] == 'Write': write += int(f[2])
+        return read, write
+
+    def Network(self, cid):
+        '''Return cumulative (rx, tx) bytes for a container, read from /proc/<pid>/net/dev of a process in its cgroup
+        '''
+        rx = tx = 0
+        path = self.FindDir('memory', cid)
+        if path is None: return 0, 0
+        pids = self.ReadFile(os.path.join(path, 'cgroup.procs')).split()
+        if pids == []: return 0, 0
+        for l in self.ReadFile(os.path.join(self.proc, pids[0], 'net', 'dev')).split('\n'):
+            if ':' not in l: continue
+            iface, counters = l.split(':', 1)
+            if iface.strip() == 'lo': continue
+            counters = counters.split()
+            rx += int(counters[0])
+            tx += int(counters[8])
+        return rx, tx
+
+    def CountersAll(self, containers):
+        '''Read the raw cumulative counters of every container (see StateFile) and return (counters, missing).
+        '''
+        counters = []
+        missing = []
+        for c in containers:
+            try:
+                r = {'id': c['id'], 'name': c['name'], 'time': time.time(), 'cpu': self.CPUUsage(c['id']),
+                     'system': 0, 'ncpu': 1}
+                r['memused'], r['memtotal'] = self.Memory(c['id'])
+            except (IOError, OSError, KeyError, ValueError):
+                missing.append(c)
+                continue
+            #network and disk are a bonus, a missing controller should not lose the cpu/memory figures
+            try:
+                r['netin'], r['netout'] = self.Network(c['id'])
+            except (IOError, OSError, ValueError, IndexError):
+                r['netin'] = r['netout'] = 0
+            try:
+                r['blkread'], r['blkwrite'] = self.BlockIO(c['id'])
+            except (IOError, OSError, ValueError):
+                r['blkread'] = r['blkwrite'] = 0
+            counters.append(r)
+        return counters, missing
+
+    def StatsAll(self, containers):
+        '''Sample every container twice, interval seconds apart, and return (stats, missing) where missing lists the
+           containers whose cgroup could not be read so the caller can fall back to docker for them.
+        '''
+        stats = []
+        missing = []
+        first = {}
+        for c in containers:
+            try:
+                first[c['id']] = self.CPUUsage(c['id'])
+            except (IOError, OSError, KeyError, ValueError):
+                missing.append(c)
+        start = time.time()
+        time.sleep(self.interval)
+        for c in containers:
+            if c['id'] not in first: continue
+            try:
+                cpudelta = self.CPUUsage(c['id']) - first[c['id']]
+                memused, memtotal = self.Memory(c['id'])
+            except (IOError, OSError, KeyError, ValueError):
+                missing.append(c)
+                continue
+            elapsed = (time.time() - start) * 1000000000.0
+            cpu = 0.0
+            if cpudelta > 0 and elapsed > 0: cpu = round(cpudelta / elapsed * 100.0, 2)
+            mem = 0.0
+            if memtotal > 0: mem = round(100.0 * memused / memtotal, 2)
+            stats.append(ContainerSample(c['name'], cpu, mem, memused, memtotal))
+        return stats, missing
+
+
+class ContainerTable():
+    '''Container state kept up to date from the docker events stream, so checks can read the current state without
+       listing containers. Containers are tracked by name so a container recreated with a new id keeps its history.
+       Every start of an already known container counts as a restart and a container changing state flapthreshold
+       times within flapwindow seconds is flagged as flapping. A container which is not running is forgotten once its
+       transitions have aged out of flapwindow, so short lived containers (docker run --rm, ci jobs) do not pile up.
+       Their restarts stay in the total so it only ever goes up.
+    '''
+    def __init__(self, flapwindow=300, flapthreshold=4):
+        self.flapwindow = flapwindow
+        self.flapthreshold = flapthreshold
+        self.lock = threading.Lock()
+        self.ids = {}                                       #id -> name
+        self.containers = {}                                #name -> {'id', 'running', 'restarts', 'transitions'}
+        self.forgottenrestarts = 0                          #restarts of the containers Prune has forgotten
+        self.healthy = False                                #False until loaded and while the event stream is down
+
+    def Load(self, containers):
+        '''Reset running state from a full container listing, keeping restart history of known containers.
+        '''
+        self.lock.acquire()
+        try:
+            for t in self.containers.values(): t['running'] = False
+            for c in containers:
+                self.Track(c['id'], c['name'])['running'] = True
+            self.healthy = True
+        finally:
+            self.lock.release()
+
+    def Track(self, cid, name):
+        t = self.containers.get(name)
+        if t is None:
+            t = {'id': cid, 'running': False, 'restarts': 0, 'transitions': []}
+            self.containers[name] = t
+        if t['id'] != cid:
+            self.ids.pop(t['id'], None)
+            t['id'] = cid
+        self.ids[cid] = name
+        return t
+
+    def Apply(self, event):
+        '''Update the table from one event, handles both the current (Action/Actor) and pre 1.22 (status/id) formats.
+        '''
+        action = event.get('Action') or event.get('status') or ''
+        actor = event.get('Actor') or {}
+        cid = actor.get('ID') or event.get('id')
+        if cid is None: return
+        name = (actor.get('Attributes') or {}).get('name') or self.ids.get(cid) or cid[:12]
+        self.lock.acquire()
+        try:
+            if action == 'rename':
+                oldname = self.ids.get(cid)
+                if oldname is not None and oldname in self.containers:
+                    self.containers[name] = self.containers.pop(oldname)
+                self.ids[cid] = name
+            elif action == 'start':
+                known = name in self.containers
+                t = self.Track(cid, name)
+                if t['running']: return
+                if known: t['restarts'] += 1
+                t['running'] = True
+                self.AddTransition(t, event)
+            elif action in ['die', 'oom', 'kill', 'stop']:
+                t = self.Track(cid, name)
+                if not t['running']: return
+                t['running'] = False
+                self.AddTransition(t, event)
+            elif action == 'destroy':
+                t = self.containers.get(name)
+                if t is not None and t['id'] == cid: t['running'] = False
+                self.ids.pop(cid, None)
+                self.Prune(event.get('time') or time.time())
+        finally:
+            self.lock.release()
+
+    def Prune(self, now):
+        '''Forget containers which are not running and have no transitions left within flapwindow, the lock must be
+           held. A container recreated under the same name within flapwindow keeps its history.
+        '''
+        for name, t in self.containers.items():
+            if t['running'] or [x for x in t['transitions'] if x > now - self.flapwindow] != []: continue
+            self.forgottenrestarts += t['restarts']
+            del self.containers[name]
+            if self.ids.get(t['id']) == name: del self.ids[t['id']]
+
+    def AddTransition(self, t, event):
+        now = event.get('time') or time.time()
+        t['transitions'] = [x for x in t['transitions'] if x > now - self.flapwindow] + [now]
+
+    def Containers(self):
+        '''Return the running containers as {'id', 'name'} records like DockerAPI.Containers
+        '''
+        self.lock.acquire()
+        try:
+            return [{'id': t['id'], 'name': name} for name, t in self.containers.items() if t['running']]
+        finally:
+            self.lock.release()
+
+    def Totals(self):
+        '''Return (restarts, flapping containers) across the containers in the table, forgetting stale ones first.
+           Restarts counts every restart seen, including those of containers since forgotten.
+        '''
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.Prune(now)
+            restarts = self.forgottenrestarts
+            flapping = 0
+            for t in self.containers.values():
+                restarts += t['restarts']
+                if len([x for x in t['transitions'] if x > now - self.flapwindow]) >= self.flapthreshold: flapping += 1
+            return restarts, flapping
+        finally:
+            self.lock.release()
+
+    def Summary(self, name):
+        '''Return (restarts, flapping) for a container name or id, None if it has never been seen.
+        '''
+        self.lock.acquire()
+        try:
+            t = self.containers.get(self.ids.get(name, name))
+            if t is None:
+                for cid in self.ids:
+                    if cid.startswith(name):
+                        t = self.containers.get(self.ids[cid])
+                        break
+            if t is None: return None
+            recent = [x for x in t['transitions'] if x > time.time() - self.flapwindow]
+            return t['restarts'], len(recent) >= self.flapthreshold
+        finally:
+            self.lock.release()
+
+
+class StateFile():
+    '''Small json file which is replaced atomically on every save. Mainly keeps the cumulative counters of each
+       container from the previous run so cpu, network and disk rates can be calculated as deltas between agent runs
+       instead of sampling twice within one run, stored as {id: [time, cpu, system, netin, netout, blkread, blkwrite]}.
+    '''
+    fields = ['time', 'cpu', 'system', 'netin', 'netout', 'blkread', 'blkwrite']
+
+    def __init__(self, path='/var/lib/check_mk_agent/dockermon.state'):
+        self.path = path
+
+    def Load(self):
+        try:
+            f = open(self.path, 'r')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(state, dict): return {}
+        return state
+
+    def Save(self, state):
+        WriteFileAtomic(self.path, json.dumps(state, separators=(',', ':')))
+
+    def Rates(self, counters):
+        '''Turn counter records into stats records using the previous run's counters, then save the new counters.
+           Containers that are gone drop out of the state, and a container seen for the first time, restarted or
+           with counters that went backwards gets a zero rate until the next run.
+        '''
+        previous = self.Load()
+        state = {}
+        stats = []
+        for r in counters:
+            if isinstance(r, ContainerSample):
+                #timed out (see GetDockerStats), keep the old baseline so the next run can still calculate a rate
+                if r.id in previous: state[r.id] = previous[r.id]
+                stats.append(r)
+                continue
+            current = [r[k] for k in self.fields]
+            state[r['id']] = current
+            s = ContainerSample(r['name'], memused=r['memused'], memtotal=r['memtotal'])
+            s.netin = s.netout = s.blkread = s.blkwrite = 0.0
+            s.firstsample = True
+            if r['memtotal'] > 0: s.mem = round(100.0 * r['memused'] / r['memtotal'], 2)
+            stats.append(s)
+            last = previous.get(r['id'])
+            if not isinstance(last, list) or len(last) != len(self.fields): continue
+            elapsed = current[0] - last[0]
+            if elapsed <= 0: continue
+            if [1 for i in range(1, len(current)) if current[i] < last[i]] != []: continue     #counter reset/restart
+            s.firstsample = False
+            cpudelta = current[1] - last[1]
+            systemdelta = current[2] - last[2]
+            if systemdelta > 0 and last[2] > 0:
+                s.cpu = round(float(cpudelta) / systemdelta * r['ncpu'] * 100.0, 2)
+            else:
+                s.cpu = round(cpudelta / (elapsed * 1000000000.0) * 100.0, 2)
+            s.netin = (current[3] - last[3]) / elapsed
+            s.netout = (current[4] - last[4]) / elapsed
+            s.blkread = (current[5] - last[5]) / elapsed
+            s.blkwrite = (current[6] - last[6]) / elapsed
+        self.Save(state)
+        return stats
+
+
+def WriteFileAtomic(path, data):
+    '''Write to a temp file in the same directory then rename it over the old file so a reader never sees a partially
+       written file.
+    '''
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory): os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(prefix='.dockermon', dir=directory)
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp): os.unlink(temp)
+        raise
+
+
+#Bytes per unit as docker prints them. Older releases (and docker info for devicemapper) print decimal SI units
+#(kB/MB/GB), newer ones binary IEC units (KiB/MiB/GiB) so both have to be taken at their real size.
+Units = {'': 1, 'B': 1,
+         'kB': 1000, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4, 'PB': 1000 ** 5,
+         'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4, 'PiB': 1024 ** 5}
+
+def ConvertMetric(value='0', metric='B'):
+    '''normalise a value based on the metric supplied
+    '''
+    #convert to bytes, an unknown unit is taken as bytes
+    return (float(value) * Units.get(metric.strip(), 1))
+
+
+def ConfigNumber(value):
+    '''Config value as an int, or a float if it has a fraction. Raises ValueError unless it is a number >= 0.
+    '''
+    try:
+        number = int(value)
+    except ValueError:
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError("not a number")
+    if number < 0: raise ValueError("must not be negative")
+    return number
+
+def ConfigInteger(value):
+    '''Config value as an int >= 0, raises ValueError otherwise.
+    '''
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError("not a whole number")
+    if number < 0: raise ValueError("must not be negative")
+    return number
+
+def ConfigChoice(*choices):
+    '''Return a converter accepting any of choices (case insensitive), the plugin compares these values lowercased.
+    '''
+    def Convert(value):
+        value = value.strip()
+        if value.lower() not in choices: raise ValueError("expected " + " or ".join(choices))
+        return value
+    return Convert
+
+def ConfigString(value):
+    return value
+
+def MonitorPattern(entry):
+    '''Return the compiled pattern of a glob (web-*) or regex (re:^web-[0-9]+$) monitor= entry, None for a plain
+       container name or id. Raises re.error for an invalid regex.
+    '''
+    if entry.startswith('re:'): return re.compile(entry[3:])
+    if '*' in entry or '?' in entry or '[' in entry: return re.compile(fnmatch.translate(entry))
+    return None
+
+
+class Thresholds(object):
+    '''Cpu and memory levels a container is checked against. One is built from the config defaults and one for each
+       monitor= entry with overrides, dockermon.ResolveThresholds maps running containers to them once per run.
+    '''
+    __slots__ = ('checkmemwarn', 'checkmemcritical', 'checkcpuwarn', 'checkcpucritical')
+
+    def __init__(self, checkmemwarn=80, checkmemcritical=90, checkcpuwarn=95, checkcpucritical=99):
+        self.checkmemwarn = checkmemwarn
+        self.checkmemcritical = checkmemcritical
+        self.checkcpuwarn = checkcpuwarn
+        self.checkcpucritical = checkcpucritical
+
+
+class ContainerSample(object):
+    '''Cpu and memory usage of one container as MonitorMetrics reports it, whichever of the api, the cli, the cgroup
+       filesystem or the state file it came from. Network and disk rates are only known when they were calculated from
+       the state file and are None otherwise. A container which did not answer in time has timedout set and no usage.
+    '''
+    __slots__ = ('name', 'id', 'cpu', 'mem', 'memused', 'memtotal', 'netin', 'netout', 'blkread', 'blkwrite',
+                 'firstsample', 'timedout')
+
+    def __init__(self, name, cpu=0.0, mem=0.0, memused=0, memtotal=0, id=None, timedout=False):
+        self.name = name
+        self.id = id
+        self.cpu = cpu
+        self.mem = mem
+        self.memused = memused
+        self.memtotal = memtotal
+        self.netin = self.netout = self.blkread = self.blkwrite = None
+        self.firstsample = False
+        self.timedout = timedout
+
+    def __repr__(self):
+        return "ContainerSample(" + ", ".join([k + "=" + repr(getattr(self, k)) for k in self.__slots__]) + ")"
 
 
 class dockermon():
+    #Config file settings -> (attribute set, converter raising ValueError for an invalid value). monitor= lines are
+    #collected in monitorlist, with any Thresholds settings after the name (monitor=web;checkmemwarn=70) in overrides.
+    ConfigKeys = {
+        #Thresholds
+        'checkmemwarn': ('checkmemwarn', ConfigNumber),
+        'checkmemcritical': ('checkmemcritical', ConfigNumber),
+        'checkcpuwarn': ('checkcpuwarn', ConfigNumber),
+        'checkcpucritical': ('checkcpucritical', ConfigNumber),
+        #datastore thresholds
+        'checkdatastorewarn': ('checkdatastorewarn', ConfigNumber),
+        'checkdatastorecritical': ('checkdatastorecritical', ConfigNumber),
+        'checkmetastorewarn': ('checkmetastorewarn', ConfigNumber),
+        'checkmetastorecritical': ('checkmetastorecritical', ConfigNumber),
+        #List each container in addition to totals
+        'DisplayAllContainers': ('DisplayAllContainers', ConfigChoice('true', 'false')),
+        #enable debug logging - only to be used for analysis, omd will not like this!
+        'Debug': ('debug', ConfigInteger),
+        #Check if Friendly names should be used
+        'ShowFriendlyNames': ('ShowFriendlyNames', ConfigChoice('yes', 'no')),
+        #Docker api
+        'UseDockerAPI': ('UseDockerAPI', ConfigChoice('yes', 'no')),
+        'DockerSocket': ('dockersocket', ConfigString),
+        #Stats collection
+        'ParallelStats': ('ParallelStats', ConfigChoice('yes', 'no')),
+        'StatsWorkers': ('statsworkers', ConfigInteger),
+        'StatsTimeout': ('statstimeout', ConfigNumber),
+        'StatsDeadline': ('statsdeadline', ConfigNumber),
+        'MetricsSource': ('MetricsSource', ConfigChoice('docker', 'cgroup')),
+        'CgroupRoot': ('cgrouproot', ConfigString),
+        'CgroupInterval': ('cgroupinterval', ConfigNumber),
+        'UseStateFile': ('UseStateFile', ConfigChoice('yes', 'no')),
+        'StateFile': ('statefile', ConfigString),
+        'InfoCacheTTL': ('infocachettl', ConfigInteger),
+        'InfoCacheFile': ('infocachefile', ConfigString),
+        #Daemon mode
+        'SpoolFile': ('spoolfile', ConfigString),
+        'SpoolMaxAge': ('spoolmaxage', ConfigNumber),
+        'DaemonInterval': ('daemoninterval', ConfigNumber),
+        'EventTracking': ('EventTracking', ConfigChoice('yes', 'no')),
+        'FlapWindow': ('flapwindow', ConfigNumber),
+        'FlapThreshold': ('flapthreshold', ConfigInteger),
+        'TimeBudget': ('timebudget', ConfigNumber),
+        'Instrumentation': ('Instrumentation', ConfigChoice('yes', 'no')),
+        'ProfileFile': ('profilefile', ConfigString),
+    }
+
     def __init__(self):
         self.checkmemwarn=80                                #Mem warning threshold %
         self.checkmemcritical=90            
@@ -24,13 +873,48 @@ class dockermon():
         self.checkmetastorecritical=90                      #Meta/Data store threshold
         
         self.ShowFriendlyNames="yes"                        #This option requires docker 1.8.2 and above to work. If using older version then set to no here or in config file.
-        self.dockerformatoption=' --format "{{.Names}}"'    #This allows customised formatting to be sent to docker commands
         
         self.monitorlist=[]                                 #List on container names which we want to monitor as being up
-        self.DisplayAllContainers=False                     #Set this to true if you want each container listed with cpu,memory utilisation etc.  
-        self.running_containers=''
+        self.overrides=[]                                   #(monitor entry, Thresholds) for entries with their own thresholds
+        self.thresholds={}                                  #Running container name -> Thresholds, see ResolveThresholds()
+        self.defaultthresholds=Thresholds()
+        self.DisplayAllContainers="false"                   #Set this to true if you want each container listed with cpu,memory utilisation etc.  
+        self.running_containers=[]                          #List of running container records, see DockerAPI.Containers
+        self.container_index={}                             #Running containers keyed by name, short id and full id
+        
+        self.UseDockerAPI="yes"                             #Talk to dockerd over its socket, set to no to force the docker cli
+        self.dockersocket='/var/run/docker.sock'
+        self.docker=None                                    #DockerAPI or DockerCLI client, see Docker()
+        self.stepclients={}                                 #Thread -> client of the budgeted check running in it, see RunStep()
+        self.ParallelStats="yes"                            #Collect container stats concurrently rather than in one blocking call
+        self.statsworkers=8                                 #Max number of containers sampled at the same time
+        self.statstimeout=10                                #Seconds to wait for a single container before giving up on it
+        self.statsdeadline=30                               #Seconds collecting stats may take in all, containers not sampled by then time out
+        self.MetricsSource="docker"                         #docker or cgroup - cgroup reads usage from /sys/fs/cgroup and only asks docker as a fallback
+        self.cgrouproot='/sys/fs/cgroup'
+        self.cgroupinterval=1                               #Seconds between the two cgroup cpu samples
+        self.UseStateFile="no"                              #Calculate rates from counters saved by the previous run instead of sampling
+        self.statefile='/var/lib/check_mk_agent/dockermon.state'
+        self.dockerinfo=None                                #docker info snapshot for this run, see GetDockerInfo()
+        self.infocachettl=0                                 #Seconds to reuse MemTotal/Driver from infocachefile between runs, 0 disables
+        self.infocachefile='/var/lib/check_mk_agent/dockermon.info'
+        
+        self.spoolfile='/var/lib/check_mk_agent/dockermon.spool'   #Output written by --daemon mode
+        self.spoolmaxage=180                                #Seconds the spool is trusted for before checking directly
+        self.daemoninterval=60                              #Seconds between collections in --daemon mode
+        self.out=OutputBuffer()                             #Output of the run, written by the caller
+        self.timebudget=50                                  #Seconds all checks have to finish in, a check which overruns is reported as unknown
+        self.budget=TimeBudget(0, self.out)                 #PrintOutput adds lines through the budget of the current run
+        self.Instrumentation="no"                           #Time every check and report it as dockermon_self_monitoring
+        self.profilefile=''                                 #Write a cProfile dump of the checks here in instrumentation mode
+        self.EventTracking="no"                             #In --daemon mode follow the docker events stream instead of listing containers
+        self.flapwindow=300                                 #Seconds over which container state changes are counted
+        self.flapthreshold=4                                #State changes within flapwindow before a container is flapping
+        self.events=None                                    #ContainerTable maintained by WatchEvents()
         
         self.debug=0		
+        self.configcache='/var/lib/check_mk_agent/dockermon.conf.cache'   #Parsed config, reused until the config file changes
+        self.configerrors=[]                                #Invalid settings found by LoadConfig, reported as Docker_Config
         self.dockerbin=''
         self.dockerpid=''
         self.dockerpidfile=''
@@ -45,15 +929,7 @@ class dockermon():
         perfdata="service_uptime="
         uptime="0"
         description=''
-        #Locate the docker binary, exit if absent. Silent exit to prevent issues with check_mk and inventory process.
-        dockerlocations = [ '/usr/bin/docker' ] #list an entry for each os type
-        for p in dockerlocations:
-            if os.path.isfile(p):
-                self.dockerbin=p
-                break
-        if self.dockerbin == '':
-          self.PrintDebug("Docker not found")
-          sys.exit(2) 
+        self.LocateDocker()
 
         #Check the process is up and running.
         dockerpidlocations = [ '/run/docker.pid', '/var/run/docker.pid' ]
@@ -93,6 +969,36 @@ class dockermon():
         self.PrintOutput(status,checkname,perfdata + uptime,description)
         return return_status
 
+    def LocateDocker(self):
+        '''Locate the docker binary, exit if absent. Silent exit to prevent issues with check_mk and inventory process.
+           
+        '''
+        dockerlocations = [ '/usr/bin/docker' ] #list an entry for each os type
+        for p in dockerlocations:
+            if os.path.isfile(p):
+                self.dockerbin=p
+                break
+        if self.dockerbin == '':
+          self.PrintDebug("Docker not found")
+          sys.exit(2) 
+
+    def Docker(self):
+        '''Return the client used to talk to docker. The api is preferred and the cli is only used if the socket is
+           unavailable or the api has been disabled in the config file. A check run by RunStep gets its own client.
+        '''
+        client = self.stepclients.get(threading.currentThread())
+        if client is not None: return client
+        if self.docker is None:
+            if str(self.UseDockerAPI).lower() != "no":
+                api = DockerAPI(self.dockersocket)
+                if api.Available():
+                    self.docker = api
+                else:
+                    self.PrintDebug("Docker api not available on " + self.dockersocket + ", using docker cli")
+            if self.docker is None:
+                self.docker = DockerCLI(self.dockerbin, self.ShowFriendlyNames.lower() != "no")
+        return self.docker
+
     def MonitorNumInstances(self):
         '''Monitor number of running containers.
            
@@ -103,13 +1009,19 @@ class dockermon():
         perfdata="Running_Instances="
         description=" Docker container(s) are running"
 
-        for l in self.running_containers.split('\n'):
-            if "CONTAINER ID" in l: continue        #ignore the header 
-            if l == '': continue                    #ignore empty lines 
-            if self.debug: print "DEBUG: " + l
+        for c in self.running_containers:
+            self.PrintDebug(c['id'] + " " + c['name'])
             count+=1
         count=str(count)
-        self.PrintOutput(status,checkname,perfdata + count,count + description)
+        perfdata += count
+        if self.events is not None and self.events.healthy:
+            #restart and flap totals across the containers the event stream has seen recently
+            restarts, flapping = self.events.Totals()
+            perfdata += "|Restarts=" + str(restarts) + "|Flapping=" + str(flapping)
+            if flapping > 0:
+                status=1
+                description += ", " + str(flapping) + " flapping"
+        self.PrintOutput(status,checkname,perfdata,count + description)
 
     def MonitorMetrics(self):
         '''Monitor cpu,memory and network for total and list each container if requested
@@ -121,103 +1033,92 @@ class dockermon():
         perfdata="-"
         description=" Docker container(s) are running"
 
-        nodelist = []
-        nlist = ""
-        cstats = []
-        totalcpu = totalmemused = name = cpu = mem = memunits = net = ''
         totalcpu = totalmem = totalmemused = 0.0
         warnlevel=""
         critlevel=""
         memtotal=1
-        #gather list of nodes
-        for l in self.running_containers.split('\n'):
-            if "CONTAINER ID" in l: continue        #ignore the header 
-            if l == '': continue                    #ignore empty lines
-            self.PrintDebug(l)
-            nodelist.append(re.split(',',re.sub('  +',',',l))[0])
-            count+=1
-        if count == 0:
+        if self.running_containers == []:
             #no containers so quit
             return
-        for n in nodelist: nlist += str(n) + " "
-        #retreive usage stats for each node and store in an array. We will then compute the total utilisation
-        container_stats=os.popen(self.dockerbin + " stats --no-stream=true " + nlist ).read()
-        for l in container_stats.split('\n'):
-            if "CONTAINER" in l: continue           #ignore the header 
-            if l == '': continue                    #ignore empty lines
-            self.PrintDebug(l)
-            #split the stats
-            l = re.sub(' / ','/',l)    #bug: docker is inconsistent between versions and sometimes there are spaces.
-            containterstats = re.split(',',re.sub('  +',',',l))
-            name = containterstats[0]
-            cpu = containterstats[1]
-            memunits = containterstats[2]
-            mem = containterstats[3]
-            #net = containterstats[0]
-
-            #calculate mem units
-            temp1, temp2 = re.split('/',memunits)
-            temp3, temp4 = re.split(' ',temp1)
-            memused = int(self.ConvertMetric(value=temp3, metric=temp4))
-            temp3, temp4 = re.split(' ',temp2)
-            memtotal = int(self.ConvertMetric(value=temp3, metric=temp4))
+        #retreive usage stats for each container. We will then compute the total utilisation
+        timedout = 0
+        thresholds = self.thresholds
+        default = self.defaultthresholds
+        levels = None
+        debug = self.debug == 1
+        displayall = self.DisplayAllContainers.lower() == "true"
+        add = self.budget.buffer().add
+        for s in self.GetContainerStats():
+            if debug: self.PrintDebug(repr(s))
+            name = s.name
+            if s.timedout:
+                #Container did not answer in time, flag it rather than lose the whole check
+                timedout += 1
+                if displayall:
+                    description="UNKNOWN - stats not returned within " + str(self.statstimeout) + "s"
+                    add(3,"Container_CPU_" + name,"-",description)
+                    add(3,"Container_Memory_" + name,"-",description)
+                continue
+            cpu = s.cpu
+            memused = s.memused
             #Bug fix, sometimes docker can incorrectly report total memory as zero and causes script to fail. Solution is to add 1 byte so we never divide by zero.
             #This is insignificant statistically :)
-            memtotal += 1
-           
-            cpu = float(re.sub('%','',cpu))
-            mem = float(re.sub('%','',mem))
-
-            warnlevel = str(int((memtotal/100.0) * float(self.checkmemwarn)))
-            critlevel = str(int((memtotal/100.0) * float(self.checkmemcritical)))
-            self.PrintDebug("Memused:" + str(memused))
-            self.PrintDebug("Memtotal:" + str(memtotal))
-
-            #if set to list each container stats then alert here
-            if self.DisplayAllContainers.lower() == "true":
-                #cpu%
-                status=0
-                checkname="Container_CPU_" + name
-                perfdata="CPU_Usage%=" + str(cpu) + ";" + str(self.checkcpuwarn) + ";" + str(self.checkcpucritical) + ";;"
-                description="Container currently utilising " + str(cpu) + "% of cpu" 
-                #Lets compare results with thresholds and categorise
-                if cpu >= self.checkcpuwarn: status=1
-                if cpu >= self.checkcpucritical: status=2
-                self.PrintOutput(status,checkname,perfdata,description)
-                
-                #realmem
-                status=0
-                checkname="Container_Memory_" + name
-                perfdata="Memory_Usage=" + str(memused) +  ";" + warnlevel + ";" + critlevel + ";0;" + str(memtotal)
-                description="Container currently utilising " + str(memused) + " of " + str(memtotal)
-                #determine is thresholds have been crossed
-                percentmemused = (100.0/memtotal) * memused
-                description = description + " = " + "{0:.2f}".format(percentmemused) + "% utilised"
-                if percentmemused >= float(self.checkmemwarn): status=1
-                if percentmemused >= float(self.checkmemcritical): status=2
-                self.PrintOutput(status,checkname,perfdata,description)
-
+            memtotal = s.memtotal + 1
             totalcpu += cpu
-            totalmem += mem
+            totalmem += s.mem
             totalmemused += memused
-            #ignore for now, container['netin'] = netin
-            #ignore for now, container['netout'] = netout
-            totalmemused=int(totalmemused)
-        
+            levels = thresholds.get(name, default)
+            if debug:
+                self.PrintDebug("Memused:" + str(memused))
+                self.PrintDebug("Memtotal:" + str(memtotal))
+            if not displayall: continue
+
+            #list each container stats and alert here, every line is formatted in one go
+            #cpu%
+            status=0
+            if cpu >= levels.checkcpuwarn: status=1
+            if cpu >= levels.checkcpucritical: status=2
+            description="Container currently utilising {0}% of cpu".format(cpu)
+            if s.firstsample: description += " (first sample, rate available from next run)"
+            add(status, "Container_CPU_" + name,
+                "CPU_Usage%={0};{1};{2};;".format(cpu, levels.checkcpuwarn, levels.checkcpucritical), description)
+
+            #realmem
+            status=0
+            percentmemused = (100.0/memtotal) * memused
+            if percentmemused >= levels.checkmemwarn: status=1
+            if percentmemused >= levels.checkmemcritical: status=2
+            add(status, "Container_Memory_" + name,
+                "Memory_Usage={0};{1};{2};0;{3}".format(memused, int((memtotal/100.0) * levels.checkmemwarn),
+                                                        int((memtotal/100.0) * levels.checkmemcritical), memtotal),
+                "Container currently utilising {0} of {1} = {2:.2f}% utilised".format(memused, memtotal, percentmemused))
+
+            #network/disk rates, only available when calculated from the state file
+            if s.netin is not None:
+                description="Network in/out {0:.0f}/{1:.0f} B/s, disk read/write {2:.0f}/{3:.0f} B/s".format(
+                    s.netin, s.netout, s.blkread, s.blkwrite)
+                if s.firstsample: description += " (first sample, rates available from next run)"
+                add(0, "Container_IO_" + name, "net_in={0:.0f}|net_out={1:.0f}|disk_read={2:.0f}|disk_write={3:.0f}".format(
+                    s.netin, s.netout, s.blkread, s.blkwrite), description)
+        totalmemused=int(totalmemused)
+        if levels is not None:
+            #the total memory line has always carried the memory levels of the last container
+            warnlevel = str(int((memtotal/100.0) * levels.checkmemwarn))
+            critlevel = str(int((memtotal/100.0) * levels.checkmemcritical))
+
         #Total cpu%
         status=0
         checkname="Docker_CPU_Total"
         perfdata="CPU_Usage%=" + str(totalcpu) + ";" + str(self.checkcpuwarn) + ";" + str(self.checkcpucritical) + ";;"
         description="Docker containers currently utilising " + str(totalcpu) + "% of cpu"
+        if timedout > 0: description += " (" + str(timedout) + " container(s) timed out)"
         #Lets compare results with thresholds and categorise
-        if totalcpu >= float(self.checkcpuwarn): status=1
-        if totalcpu >= float(self.checkcpucritical): status=2
+        if totalcpu >= self.checkcpuwarn: status=1
+        if totalcpu >= self.checkcpucritical: status=2
         self.PrintOutput(status,checkname,perfdata,description)
 
-        #BUG - We will extract the total memory that docker can see
-        tempmemtotal=os.popen(self.dockerbin + " info  2> /dev/null | grep 'Total Memory'").read().split(": ")[1]
-        temp1, temp2 = re.split(' ',tempmemtotal)
-        memtotal = int(self.ConvertMetric(value=temp1, metric=temp2))
+        #We will extract the total memory that docker can see
+        memtotal = self.GetStaticInfo()['MemTotal']
 
         #Total realmem
         status=0
@@ -227,8 +1128,9 @@ class dockermon():
         #determine is thresholds have been crossed
         percentmemused = (100.0/memtotal) * totalmemused
         description = description + " or " + "{0:.2f}".format(percentmemused) + "%"
-        if percentmemused >= float(self.checkmemwarn): status=1
-        if percentmemused >= float(self.checkmemcritical): status=2
+        if timedout > 0: description += " (" + str(timedout) + " container(s) timed out)"
+        if percentmemused >= self.checkmemwarn: status=1
+        if percentmemused >= self.checkmemcritical: status=2
         self.PrintOutput(status,checkname,perfdata,description)
         
     def MonitorFileSystems(self):
@@ -250,21 +1152,45 @@ class dockermon():
             self.PrintDebug("No container names defined in config file")
             return
 
+        #Plain entries are exact lookups in the container index, glob (web-*) and regex (re:^web-[0-9]+$) entries are
+        #collected and matched against every running container in a single pass afterwards.
+        patterns = []
         for c in self.monitorlist:
-            status=2
-            description = "Container is DOWN!"
-            perfdata="Status=0"
-            for l in self.running_containers.split('\n'):
-                if "CONTAINER ID" in l: continue        #ignore the header 
-                if l == '': continue                    #ignore empty lines 
-                if c in l:
-                    #continer is up
-                    status=0
-                    description = "Container is UP!"
-                    perfdata="Status=1"
-                    
-                if status == 0: break
-            self.PrintOutput(status,checkname + c,perfdata, description)
+            try:
+                pattern = MonitorPattern(c)
+            except re.error, e:
+                self.PrintOutput(3,checkname + c,"-","UNKNOWN - invalid regex (" + str(e) + ")")
+                continue
+            if pattern is not None:
+                patterns.append((c, pattern))
+                continue
+            if c in self.container_index:
+                #continer is up
+                status, perfdata, description = 0, "Status=1", "Container is UP!"
+            else:
+                status, perfdata, description = 2, "Status=0", "Container is DOWN!"
+            summary = None
+            if self.events is not None and self.events.healthy: summary = self.events.Summary(c)
+            if summary is not None:
+                perfdata += "|Restarts=" + str(summary[0]) + "|Flapping=" + str(int(summary[1]))
+                if summary[1]:
+                    description += " Container is flapping, " + str(summary[0]) + " restart(s)"
+                    if status == 0: status=1
+            self.PrintOutput(status,checkname + c,perfdata,description)
+
+        if patterns == []: return
+        matches = {}
+        for p in patterns: matches[p[0]] = []
+        for l in self.running_containers:
+            for p in patterns:
+                if p[1].match(l['name']) or p[1].match(l['id']): matches[p[0]].append(l['name'])
+        for p in patterns:
+            found = matches[p[0]]
+            if found == []:
+                self.PrintOutput(2,checkname + p[0],"Status=0|Matches=0","No container matching " + p[0] + " is UP!")
+            else:
+                self.PrintOutput(0,checkname + p[0],"Status=1|Matches=" + str(len(found)),
+                                 str(len(found)) + " container(s) matching " + p[0] + " UP (" + ",".join(found) + ")")
                 
     def MonitorMetaDataStores(self):
         '''Monitor the Datastore and Metastore usage - This is critical due to the fact that docker is allocating thin storage (normally 10gb at a time) and can easily be over provisioned :(
@@ -284,13 +1210,16 @@ class dockermon():
         temp1 = ""
         temp2 = ""
         
-        #Harvest docker info and stripout the information we want
-        dockerinfo=os.popen(self.dockerbin + " info 2> /dev/null" ).readlines()
-        for l in dockerinfo:
-            if 'Data Space Used: ' in l : dataused = re.sub('^ Data Space Used: ','',l)
-            if 'Data Space Available: ' in l : dataavailable = re.sub('^ Data Space Available: ','',l)
-            if 'Metadata Space Used: ' in l : metaused = re.sub('^ Metadata Space Used: ','',l)
-            if 'Metadata Space Available: ' in l : metaavailable = re.sub('^ Metadata Space Available: ','',l)
+        #Only devicemapper has data/meta stores, no need to ask docker for info when we already know the driver
+        if self.GetStaticInfo()['Driver'] not in ['', 'devicemapper']:
+            return
+
+        #Harvest docker info and pick out the information we want
+        driverstatus = self.GetDockerInfo()['DriverStatus']
+        dataused = driverstatus.get('Data Space Used', '')
+        dataavailable = driverstatus.get('Data Space Available', '')
+        metaused = driverstatus.get('Metadata Space Used', '')
+        metaavailable = driverstatus.get('Metadata Space Available', '')
         
 	#Fix: might not be using DM so no meta/data percentages will be shown. Instead of erroring we will now silently exit the method to protect OMD.
         if dataused == "" or dataavailable == "" or metaused == "" or metaavailable == "":
@@ -300,10 +1229,10 @@ class dockermon():
             #Datastore usage - extract, convert and calculate
             temp1, temp2 = re.split(' ', dataused)
             self.PrintDebug("(T1,T2) = " + temp1 + "," + temp2)
-            dataused = int(self.ConvertMetric(value=temp1, metric=temp2))
+            dataused = int(ConvertMetric(value=temp1, metric=temp2))
             temp1, temp2 = re.split(' ', dataavailable)
             self.PrintDebug("(T1,T2) = " + temp1 + "," + temp2)
-            dataavailable = int(self.ConvertMetric(value=temp1, metric=temp2))
+            dataavailable = int(ConvertMetric(value=temp1, metric=temp2))
             datausedpercent = 100 / float(dataused + dataavailable) * dataused
             if datausedpercent >= self.checkdatastorewarn: 
                 #Warning threshold has been met
@@ -317,9 +1246,9 @@ class dockermon():
             
             #Metastore usage - extract, convert and calculate
             temp1, temp2 = re.split(' ', metaused)
-            metaused = int(self.ConvertMetric(value=temp1, metric=temp2))
+            metaused = int(ConvertMetric(value=temp1, metric=temp2))
             temp1, temp2 = re.split(' ', metaavailable)
-            metaavailable = int(self.ConvertMetric(value=temp1, metric=temp2))
+            metaavailable = int(ConvertMetric(value=temp1, metric=temp2))
             metausedpercent = 100 / float(metaused + metaavailable) * metaused
             if metausedpercent >= self.checkmetastorewarn: 
                 #Warning threshold has been met
@@ -337,10 +1266,10 @@ class dockermon():
             self.PrintOutput(status,checkname,perfdata,description)
             
     def PrintOutput(self,status=0, checkname='', perfdata='-', description=''):
-        '''Print correctly formatted output for check_mk
+        '''Add a line of output for check_mk to the output of the check currently running
            
         '''
-        print "{0} {1} {2} {3}".format(status, checkname, perfdata, description)
+        self.budget.add(status, checkname, perfdata, description)
 
     def PrintDebug(self,message=''):
         '''If debug is enabled, then print the message to stdout (this should only be used from the commandline to assist with erroneous data analysis)
@@ -351,20 +1280,7 @@ class dockermon():
     def ConvertMetric(self,value='0', metric='B'):
         '''normalise a value based on the metric supplied
         '''
-        #determine what metric is being used and convert to bytes (approximate value only)
-        metric = metric.rstrip()
-        if metric in ['TB', 'TiB']: 
-            multiplier = 1024 * 1024 * 1024 * 1024
-        elif metric in ['GB', 'GiB']:
-            multiplier = 1024 * 1024 * 1024
-        elif metric in ['MB', 'MiB']:
-            multiplier = 1024 * 1024
-        elif metric in ['KB', 'KiB']:
-            multiplier = 1024
-        else:
-            multiplier = 1
-            
-        return (float(value) * multiplier)
+        return ConvertMetric(value, metric)
 
     def LoadConfig(self,configfile="/etc/check_mk/dockermon.conf"):
         '''Load a config file which will allow parameters to be stored outside of the script and will contain list of containers to watch, thresholds etc.
@@ -372,47 +1288,119 @@ class dockermon():
         '''
         #Check if config exists, if not create one and exit silently unless debug is enabled
         if os.path.isfile(configfile):
-            conffile=open(configfile, 'r')
-            conf=conffile.readlines()
-            conffile.close()
-            for l in conf:
-                if re.search('^#', l): continue         #comments
-                if l == '': continue                    #ignore empty lines
-                #Thresholds
-                if 'checkmemwarn=' in l: self.checkmemwarn=re.sub('^.*=','',l.rstrip())
-                if 'checkmemcritical=' in l: self.checkmemcritical=re.sub('^.*=','',l.rstrip())
-                if 'checkcpuwarn=' in l: self.checkcpuwarn=re.sub('^.*=','',l.rstrip())
-                if 'checkcpucritical=' in l: self.checkcpucritical=re.sub('^.*=','',l.rstrip())
-                #datastore thresholds
-                if 'checkdatastorewarn=' in l: self.checkdatastorewarn=re.sub('^.*=','',l.rstrip())
-                if 'checkdatastorecritical=' in l: self.checkdatastorewarn=re.sub('^.*=','',l.rstrip())
-                if 'checkmetastorewarn=' in l: self.checkmetastorewarn=re.sub('^.*=','',l.rstrip())
-                if 'checkmetastorecritical=' in l: self.checkmetastorewarn=re.sub('^.*=','',l.rstrip())
-                #List each container in addition to totals
-                if 'DisplayAllContainers=' in l: self.DisplayAllContainers=re.sub('^.*=','',l.rstrip())
-                #enable debug logging - only to be used for analysis, omd will not like this!
-                if 'Debug=' in l: self.DisplayAllContainers=re.sub('^.*=','',l.rstrip())
-                #Check if Friendly names should be used
-                if 'ShowFriendlyNames=' in l: self.ShowFriendlyNames=re.sub('^.*=','',l.rstrip())
-                #Container lists
-                if 'monitor=' in l: self.monitorlist.append(re.sub('^.*=','',l.rstrip()))
-
-            if self.ShowFriendlyNames.lower()=="no":  self.dockerformatoption=""
+            self.configerrors=[]
+            for key, value in read_config(configfile, self.configcache):
+                if key == 'monitor':
+                    #Container lists
+                    self.AddMonitor(value)
+                elif key in self.ConfigKeys:
+                    attribute, convert = self.ConfigKeys[key]
+                    try:
+                        setattr(self, attribute, convert(value))
+                    except ValueError, e:
+                        self.configerrors.append(key + "=" + value.strip() + " (" + str(e) + ")")
+                elif key != '[':
+                    self.configerrors.append(key + " (unknown setting)")
+            self.defaultthresholds = Thresholds(self.checkmemwarn, self.checkmemcritical, self.checkcpuwarn, self.checkcpucritical)
+
             self.PrintDebug("checkmemwarn=" + str(self.checkmemwarn))
             self.PrintDebug("checkmemcrit=" + str(self.checkmemcritical))
             self.PrintDebug("checkcpuwarn=" + str(self.checkcpuwarn))
             self.PrintDebug("checkcpucrit=" + str(self.checkcpucritical))
             self.PrintDebug('checkdatastorewarn=' + str(self.checkdatastorewarn))
-            self.PrintDebug('checkdatastorecritical=' + str(self.checkdatastorewarn))
+            self.PrintDebug('checkdatastorecritical=' + str(self.checkdatastorecritical))
             self.PrintDebug('checkmetastorewarn=' + str(self.checkmetastorewarn))
-            self.PrintDebug('checkmetastorecritical=' + str(self.checkmetastorewarn))
+            self.PrintDebug('checkmetastorecritical=' + str(self.checkmetastorecritical))
             self.PrintDebug('DisplayAllContainers=' + str(self.DisplayAllContainers))
             self.PrintDebug("Monitor List=" + str(self.monitorlist))
+            for entry, levels in self.overrides:
+                self.PrintDebug("Thresholds " + entry + "=" + str([getattr(levels, k) for k in Thresholds.__slots__]))
+            if self.configerrors != []: self.PrintDebug("Invalid settings=" + str(self.configerrors))
             self.PrintDebug("ShowFriendlyNames=" + str(self.ShowFriendlyNames))
+            self.PrintDebug("UseDockerAPI=" + str(self.UseDockerAPI))
+            self.PrintDebug("DockerSocket=" + str(self.dockersocket))
+            self.PrintDebug("ParallelStats=" + str(self.ParallelStats))
+            self.PrintDebug("StatsWorkers=" + str(self.statsworkers))
+            self.PrintDebug("StatsTimeout=" + str(self.statstimeout))
+            self.PrintDebug("StatsDeadline=" + str(self.statsdeadline))
+            self.PrintDebug("MetricsSource=" + str(self.MetricsSource))
+            self.PrintDebug("CgroupRoot=" + str(self.cgrouproot))
+            self.PrintDebug("CgroupInterval=" + str(self.cgroupinterval))
+            self.PrintDebug("UseStateFile=" + str(self.UseStateFile))
+            self.PrintDebug("StateFile=" + str(self.statefile))
+            self.PrintDebug("InfoCacheTTL=" + str(self.infocachettl))
+            self.PrintDebug("InfoCacheFile=" + str(self.infocachefile))
+            self.PrintDebug("SpoolFile=" + str(self.spoolfile))
+            self.PrintDebug("SpoolMaxAge=" + str(self.spoolmaxage))
+            self.PrintDebug("DaemonInterval=" + str(self.daemoninterval))
+            self.PrintDebug("EventTracking=" + str(self.EventTracking))
+            self.PrintDebug("FlapWindow=" + str(self.flapwindow))
+            self.PrintDebug("FlapThreshold=" + str(self.flapthreshold))
+            self.PrintDebug("TimeBudget=" + str(self.timebudget))
+            self.PrintDebug("Instrumentation=" + str(self.Instrumentation))
+            self.PrintDebug("ProfileFile=" + str(self.profilefile))
         else:
-            self.GenerateConfig()
+            self.GenerateConfig(configfile)
             exit(1)
-            
+
+    def AddMonitor(self, value):
+        '''Add a monitor= entry. Threshold settings may follow the name separated by ; (monitor=web;checkmemwarn=70),
+           they apply to every container the entry matches and are resolved by ResolveThresholds.
+        '''
+        fields = value.strip().split(';')
+        name = fields[0].strip()
+        self.monitorlist.append(name)
+        if len(fields) == 1: return
+        levels = None
+        for field in fields[1:]:
+            key, sep, setting = field.partition('=')
+            key = key.strip()
+            if key not in Thresholds.__slots__:
+                self.configerrors.append("monitor=" + value.strip() + " (" + key + " is not a container threshold)")
+                continue
+            try:
+                setting = ConfigNumber(setting)
+            except ValueError, e:
+                self.configerrors.append("monitor=" + value.strip() + " (" + key + " " + str(e) + ")")
+                continue
+            if levels is None:
+                #defaults are filled in by ResolveThresholds once the whole config is loaded
+                levels = Thresholds(None, None, None, None)
+            setattr(levels, key, setting)
+        if levels is not None: self.overrides.append((name, levels))
+
+    def ResolveThresholds(self):
+        '''Map each running container with a monitor= override to its Thresholds in self.thresholds, any other
+           container uses self.defaultthresholds. Exact names and ids are looked up, glob and regex entries are matched
+           against every running container once here so the metrics loop only does a dict lookup. An exact entry
+           takes precedence over a pattern, otherwise the first entry matching a container wins.
+        '''
+        default = self.defaultthresholds
+        self.thresholds = {}
+        patterns = []
+        for entry, overrides in self.overrides:
+            levels = Thresholds()
+            for k in Thresholds.__slots__:
+                value = getattr(overrides, k)
+                if value is None: value = getattr(default, k)
+                setattr(levels, k, value)
+            try:
+                pattern = MonitorPattern(entry)
+            except re.error:
+                #reported by MonitorIsContainerUp
+                continue
+            if pattern is not None:
+                patterns.append((pattern, levels))
+            elif entry in self.container_index:
+                self.thresholds.setdefault(self.container_index[entry]['name'], levels)
+        if patterns == []: return
+        for c in self.running_containers:
+            if c['name'] in self.thresholds: continue
+            for pattern, levels in patterns:
+                if pattern.match(c['name']) or pattern.match(c['id']):
+                    self.thresholds[c['name']] = levels
+                    break
+
     def GenerateConfig(self,configfile="/etc/check_mk/dockermon.conf"):
         '''Generate a default config file which can be customised by an admin.
 
@@ -426,6 +1414,40 @@ class dockermon():
         conffile.write('Debug=0\n')
         conffile.write('ShowFriendlyNames=yes\n')
         conffile.write('DisplayAllContainers=False\n\n')
+        conffile.write('#Docker api - talk to dockerd over its socket, set UseDockerAPI=no to fall back to the docker cli\n')
+        conffile.write('UseDockerAPI=yes\n')
+        conffile.write('DockerSocket=/var/run/docker.sock\n\n')
+        conffile.write('#Container stats - sample containers concurrently, giving up on any container slower than StatsTimeout seconds\n')
+        conffile.write('#and on every container not sampled within StatsDeadline seconds in all\n')
+        conffile.write('ParallelStats=yes\n')
+        conffile.write('StatsWorkers=8\n')
+        conffile.write('StatsTimeout=10\n')
+        conffile.write('StatsDeadline=30\n\n')
+        conffile.write('#Where container cpu/memory comes from - docker or cgroup (read /sys/fs/cgroup directly, docker is only asked for containers not found there)\n')
+        conffile.write('MetricsSource=docker\n')
+        conffile.write('CgroupRoot=/sys/fs/cgroup\n')
+        conffile.write('CgroupInterval=1\n\n')
+        conffile.write('#Calculate cpu/network/disk rates from the counters saved by the previous run, no sampling wait\n')
+        conffile.write('UseStateFile=no\n')
+        conffile.write('StateFile=/var/lib/check_mk_agent/dockermon.state\n\n')
+        conffile.write('#Reuse total memory and storage driver from docker info for this many seconds between runs, 0 disables\n')
+        conffile.write('InfoCacheTTL=0\n')
+        conffile.write('InfoCacheFile=/var/lib/check_mk_agent/dockermon.info\n\n')
+        conffile.write('#Daemon mode - when check_mk_docker.py --daemon is running it collects every DaemonInterval seconds into\n')
+        conffile.write('#SpoolFile and the agent just prints that file while it is younger than SpoolMaxAge seconds\n')
+        conffile.write('SpoolFile=/var/lib/check_mk_agent/dockermon.spool\n')
+        conffile.write('SpoolMaxAge=180\n')
+        conffile.write('DaemonInterval=60\n')
+        conffile.write('#Follow the docker events stream in daemon mode, adds restart counts and flap detection to container checks\n')
+        conffile.write('EventTracking=no\n')
+        conffile.write('FlapWindow=300\n')
+        conffile.write('FlapThreshold=4\n\n')
+        conffile.write('#Seconds all checks have to finish in, a check still running then is reported as unknown. Keep this below the agent timeout, 0 disables\n')
+        conffile.write('TimeBudget=50\n\n')
+        conffile.write('#Instrumentation - time every check, the time spent waiting on docker and the bytes parsed, reported as the\n')
+        conffile.write('#dockermon_self_monitoring check. Set ProfileFile to also write a cProfile dump of each run there\n')
+        conffile.write('Instrumentation=no\n')
+        conffile.write('ProfileFile=\n\n')
         conffile.write('#Thresolholds\n')
         conffile.write('checkmemwarn=80\n')
         conffile.write('checkmemcritical=90\n')
@@ -436,9 +1458,14 @@ class dockermon():
         conffile.write('checkmetastorewarn=80\n')
         conffile.write('checkmetastorecritical=90\n')
         conffile.write('\n\n#Monitor Containers\n')
-        conffile.write('#List any container which you want track that they are running.  You can reference by uid or use the friendly container name.\n#Examples:\n')
+        conffile.write('#List any container which you want track that they are running.  You can reference by uid or use the friendly container name.\n')
+        conffile.write('#Names must match exactly, use a glob or prefix a regex with re: to track a group of containers.\n#Examples:\n')
         conffile.write('#monitor=1d1792684b10\n')
         conffile.write('#monitor=Mycontainer\n')
+        conffile.write('#monitor=web-*\n')
+        conffile.write('#monitor=re:^worker-[0-9]+$\n')
+        conffile.write('#Cpu and memory thresholds can be set per container after its name, separated by ;\n')
+        conffile.write('#monitor=web-*;checkmemwarn=70;checkmemcritical=85\n')
         conffile.close()
         os.chmod(configfile, 0755)        
 
@@ -446,16 +1473,274 @@ class dockermon():
         '''Generate a list of running containers which will be used by other functions.
            
         '''
-        self.running_containers=os.popen(self.dockerbin + " ps" + self.dockerformatoption).read()
+        #Start of a new collection run so forget the previous docker info snapshot
+        self.dockerinfo=None
+        if self.events is not None and self.events.healthy:
+            self.running_containers=self.events.Containers()
+        else:
+            self.running_containers=self.Docker().Containers()
+        self.container_index={}
+        for c in self.running_containers:
+            self.container_index[c['name']] = c
+            self.container_index[c['id']] = c
+            self.container_index[c['id'][:12]] = c
+        if self.ShowFriendlyNames.lower()=="no":
+            #Report containers by their short id as the docker cli would have done
+            for c in self.running_containers: c['name'] = c['id'][:12]
+        self.ResolveThresholds()
+        return True
 
-if __name__ == "__main__":
+    def GetDockerInfo(self):
+        '''Return docker info, asking the daemon only once per run however many checks need it.
+           
+        '''
+        if self.dockerinfo is None:
+            self.dockerinfo = self.Docker().Info()
+            if int(self.infocachettl) > 0:
+                try:
+                    StateFile(self.infocachefile).Save({'time': time.time(), 'MemTotal': self.dockerinfo['MemTotal'],
+                                                        'Driver': self.dockerinfo['Driver']})
+                except (IOError, OSError), e:
+                    self.PrintDebug("Unable to write info cache " + self.infocachefile + " (" + str(e) + ")")
+        return self.dockerinfo
+
+    def GetStaticInfo(self):
+        '''Return the docker info fields which rarely change (MemTotal and Driver). These come from the info cache
+           file if it is younger than InfoCacheTTL, saving the docker info call entirely on devicemapper-free hosts.
+           
+        '''
+        if self.dockerinfo is None and int(self.infocachettl) > 0:
+            cached = StateFile(self.infocachefile).Load()
+            if time.time() - cached.get('time', 0) < int(self.infocachettl) and 'MemTotal' in cached and 'Driver' in cached:
+                return cached
+        return self.GetDockerInfo()
+
+    def GetContainerStats(self):
+        '''Return a stats record for each running container (see DockerAPI.Stats) from the configured MetricsSource.
+           
+        '''
+        containers = self.running_containers
+        stats = []
+        if self.UseStateFile.lower() == "yes":
+            counters, containers = self.GetContainerCounters(containers)
+            try:
+                stats += StateFile(self.statefile).Rates(counters)
+            except (IOError, OSError), e:
+                self.PrintDebug("Unable to update state file " + self.statefile + " (" + str(e) + ")")
+        if containers != [] and self.MetricsSource.lower() == "cgroup":
+            cgroupstats, containers = CgroupStats(self.cgrouproot, float(self.cgroupinterval)).StatsAll(containers)
+            stats += cgroupstats
+            if containers != []:
+                self.PrintDebug("No cgroup found for " + ",".join([c['name'] for c in containers]) + ", asking docker")
+        stats += self.GetDockerStats(containers)
+        return stats
+
+    def GetContainerCounters(self, containers):
+        '''Return (counters, remaining) where counters are raw cumulative counter records for StateFile and remaining
+           are the containers they could not be read for, which have to be sampled instead.
+           
+        '''
+        if self.MetricsSource.lower() == "cgroup":
+            return CgroupStats(self.cgrouproot).CountersAll(containers)
+        if isinstance(self.Docker(), DockerCLI):
+            #the cli only gives out percentages, not counters
+            return [], containers
+        return self.GetDockerStats(containers, 'Counters'), []
+
+    def GetDockerStats(self, containers, method='Stats'):
+        '''Return a stats record (or counter record if method is Counters) for each container as reported by docker.
+           Containers which do not answer within statstimeout, or are not sampled before the statsdeadline of the whole
+           collection, are returned as a ContainerSample with timedout set.
+           
+        '''
+        if containers == []: return []
+        docker = self.Docker()
+        deadline = time.time() + float(self.statsdeadline)
+        if self.ParallelStats.lower() == "no":
+            if isinstance(docker, DockerCLI):
+                return docker.StatsAll(containers)
+            return self.CollectStats(docker.Clone(), containers, method, deadline)
+
+        #Fan the containers out over a pool of worker threads, each with its own connection to docker, so the
+        #time taken follows the slowest container rather than the number of containers.
+        pending = Queue.Queue()
+        for c in containers: pending.put(c)
+        results = {}
+        workers = []
+        for i in range(max(1, min(int(self.statsworkers), len(containers)))):
+            w = threading.Thread(target=self.StatsWorker, args=(docker.Clone(float(self.statstimeout)), method, pending, results, deadline))
+            w.setDaemon(True)
+            w.start()
+            workers.append(w)
+        #Workers still busy at the deadline are left behind, the containers they have not answered for time out
+        for w in workers:
+            w.join(max(0, deadline - time.time()))
+
+        stats = []
+        for c in containers:
+            if c['id'] in results:
+                if results[c['id']] is not None: stats.append(results[c['id']])
+            else:
+                stats.append(ContainerSample(c['name'], id=c['id'], timedout=True))
+        return stats
+
+    def StatsWorker(self, docker, method, pending, results, deadline):
+        '''Worker thread for GetContainerStats, keeps taking containers from the queue until it is empty or the
+           deadline has passed.
+        '''
+        while time.time() < deadline:
+            try:
+                c = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[c['id']] = getattr(docker, method)(c)
+            except DockerTimeout, e:
+                self.PrintDebug(str(e))
+                results[c['id']] = ContainerSample(c['name'], id=c['id'], timedout=True)
+            except DockerAPIError, e:
+                #container may have stopped since we listed it
+                self.PrintDebug(str(e))
+                results[c['id']] = None
+
+    def CollectStats(self, docker, containers, method='Stats', deadline=None):
+        '''Sample each container in turn, used when parallel collection is disabled. Containers which time out, or
+           are reached after the deadline, are returned as a ContainerSample with timedout set.
+        '''
+        stats = []
+        for c in containers:
+            if deadline is not None and time.time() >= deadline:
+                stats.append(ContainerSample(c['name'], id=c['id'], timedout=True))
+                continue
+            try:
+                stats.append(getattr(docker, method)(c))
+            except DockerTimeout, e:
+                self.PrintDebug(str(e))
+                stats.append(ContainerSample(c['name'], id=c['id'], timedout=True))
+            except DockerAPIError, e:
+                #container may have stopped since we listed it
+                self.PrintDebug(str(e))
+        return stats
+
+    def Collect(self):
+        '''Run every check once within the time budget, each check is cut off and reported as unknown if the budget
+           runs out before it finishes.
+           
+        '''
+        if self.Instrumentation.lower() == "yes": instrumentation.enable(self.profilefile)
+        self.budget = TimeBudget(self.timebudget, self.out)
+        if self.configerrors != []:
+            self.PrintOutput(1, 'Docker_Config', '-', "WARN - Ignored invalid setting(s): " + ", ".join(self.configerrors))
+        if self.RunStep('Docker_Service', self.MonitorDaemon):
+            if self.RunStep('Docker_Containers', self.RunningContainerList):
+                self.RunStep('Docker_Containers', self.MonitorNumInstances)
+                self.RunStep('Docker_Metrics', self.MonitorMetrics)
+                self.RunStep('Container_Status', self.MonitorIsContainerUp)
+                self.RunStep('Docker_DataStores', self.MonitorMetaDataStores)
+        instrumentation.report(self.out, 'dockermon_self_monitoring')
+
+    def RunStep(self, name, check, *args):
+        '''Run a check within the time budget with a docker client of its own. A check cut off by the budget is left
+           running in the background, on a shared keep-alive connection the checks after it would send requests while
+           it is still reading its response.
+           
+        '''
+        return self.budget.run(name, self.StepClient, check, *args)
+
+    def StepClient(self, check, *args):
+        '''Run check with Docker() returning a clone of the client for the calling thread only.
+           
+        '''
+        current = threading.currentThread()
+        client = self.stepclients[current] = self.Docker().Clone()
+        try:
+            return check(*args)
+        finally:
+            del self.stepclients[current]
+            if isinstance(client, DockerAPI): client.Close()
+
+    def WatchEvents(self):
+        '''Background thread for --daemon mode keeping self.events up to date from the docker events stream. The
+           table is reloaded from a full listing whenever the stream (re)connects, events since just before the
+           listing are replayed so nothing falls in the gap.
+           
+        '''
+        while True:
+            api = DockerAPI(self.dockersocket, None)
+            try:
+                since = time.time() - 1
+                self.events.Load(api.Containers())
+                api.Close()
+                for event in api.Events(since):
+                    self.events.Apply(event)
+            except Exception:
+                self.PrintDebug(traceback.format_exc())
+            api.Close()
+            #stream ended or failed, fall back to listing containers until it is back
+            self.events.healthy = False
+            time.sleep(5)
+
+    def PrintSpool(self):
+        '''Print the output collected by the daemon if it is fresh enough, return False if the caller has to collect.
+           
+        '''
+        try:
+            if time.time() - os.stat(self.spoolfile).st_mtime > float(self.spoolmaxage): return False
+            f = open(self.spoolfile, 'r')
+            try:
+                sys.stdout.write(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return False
+        return True
+
+    def RunDaemon(self):
+        '''Keep collecting every daemoninterval seconds and atomically replace the spool file with the rendered output.
+           A failed collection leaves the previous spool in place so it ages out and the agent falls back to checking
+           directly.
+           
+        '''
+        if self.EventTracking.lower() == "yes":
+            self.events = ContainerTable(float(self.flapwindow), int(self.flapthreshold))
+            w = threading.Thread(target=self.WatchEvents)
+            w.setDaemon(True)
+            w.start()
+        while True:
+            started = time.time()
+            self.out = OutputBuffer()
+            try:
+                self.Collect()
+                WriteFileAtomic(self.spoolfile, self.out.render())
+            except Exception:
+                self.PrintDebug(traceback.format_exc())
+                #start from a fresh docker connection next time in case dockerd was restarted
+                self.docker = None
+            time.sleep(max(1, float(self.daemoninterval) - (time.time() - started)))
+
+
+def main():
+    '''Run the check, or the daemon with --daemon. The agent runs this through the check_mk_docker executable so the
+       bytecode of this module is cached instead of compiled on every run. The config is read from MK_CONFDIR and
+       cached in MK_VARDIR when the agent exports them.
+
+    '''
     p=dockermon()
-    if p.MonitorDaemon():
-        p.debug=0
-        p.DisplayAllContainers=False
-        p.LoadConfig()
-        p.RunningContainerList()
-        p.MonitorNumInstances()
-        p.MonitorMetrics()
-        p.MonitorIsContainerUp()
-        p.MonitorMetaDataStores()
+    p.LocateDocker()
+    p.debug=0
+    p.DisplayAllContainers="false"
+    p.configcache=os.path.join(os.environ.get('MK_VARDIR', '/var/lib/check_mk_agent'), 'dockermon.conf.cache')
+    p.LoadConfig(os.path.join(os.environ.get('MK_CONFDIR', '/etc/check_mk'), 'dockermon.conf'))
+    if '--daemon' in sys.argv[1:]:
+        p.RunDaemon()
+    elif not p.PrintSpool():
+        p.Collect()
+        p.out.flush()
+
+
+if __name__ == "__main__":
+    #Run as a script, the way installs from before the check_mk_docker executable still run it. Where the agent has
+    #the executable next to this file it runs that as well, so the check is left to it rather than reported twice.
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_mk_docker')
+    if '--daemon' in sys.argv[1:] or 'MK_CONFDIR' not in os.environ or not os.access(wrapper, os.X_OK):
+        main()
@@ -5,8 +5,15 @@
 #
 #   Version      Author          Description      
 #     0.1        Nigel Heaney    Initial version
+#     0.2                        Check containers in parallel with a timeout per container
+#     0.3                        Optional host side collection (DF_MODE=host) which does not need df in the container
+#     0.4                        Host mode unescapes mount points with spaces, tabs or backslashes in them
 
 BLACKLIST="#"
+DF_WORKERS=8                #how many containers are checked at the same time
+DF_TIMEOUT=10               #seconds to wait for a container before skipping it
+DF_MODE=exec                #exec runs df inside each container, host reads the container mounts from the host side
+DF_FILTER='\/docker-'       #only report filesystems matching this regex
 
 CONFFILE='/etc/check_mk/check_mk_docker_df.conf'
 if [ ! -e $CONFFILE ]; then 
@@ -14,11 +21,66 @@ if [ ! -e $CONFFILE ]; then
     echo "#Add container names or ID's to blacklist if you want them to be excluded from omd monitoring." > $CONFFILE
     echo '#e.g This is a regex string so BLACKLIST="stg-proxy|redis|test|536ff129ce47" would exclude all of container which contain any of these.' >> $CONFFILE
     echo 'BLACKLIST="#"' >> $CONFFILE
+    echo '#Number of containers checked at the same time and seconds before a hung container is skipped' >> $CONFFILE
+    echo 'DF_WORKERS=8' >> $CONFFILE
+    echo 'DF_TIMEOUT=10' >> $CONFFILE
+    echo '#exec runs df inside every container, host reads the container mounts from /proc/<pid> on the host (no df needed in the image)' >> $CONFFILE
+    echo 'DF_MODE=exec' >> $CONFFILE
 fi    
 
 #Source the config file so we can override defaults.
 source $CONFFILE
 
-echo "<<<df>>>"
-for c in $(docker ps --format "{{.Names}}" | egrep -v $BLACKLIST) ; do docker exec $c df -kTPB 1024| grep -E '\/docker-' | sed "s/$/_container_$c/g";done
+collect_df_exec ()
+{
+    #Grab filesystem usage by running df inside the container.
+    c=$1
+    docker exec $c df -kTPB 1024 2>/dev/null | grep -E "$DF_FILTER" | sed "s/$/_container_$c/g"
+}
+
+collect_df_host ()
+{
+    #Build the same lines as df from the host: list the container's mounts from /proc/<pid>/mountinfo and statvfs each
+    #one through /proc/<pid>/root, so nothing is started inside the container. mountinfo escapes space, tab, newline and
+    #backslash in its fields as exactly three octal digits (\040), printf %b reads up to three after a \0 so every \
+    #becomes \0 first, else a digit following the escape (\0401) is taken into it. The real paths are handed to awk
+    #through its environment as -v would interpret any backslash left in them again.
+    c=$1
+    pid=$2
+    awk '{ for (i = 7; $i != "-"; i++) ; print $(i+2), $(i+1), $5 }' /proc/$pid/mountinfo | while read -r source fstype mp; do
+        printf -v source '%b' "${source//\\/\\0}"
+        printf -v mp '%b' "${mp//\\/\\0}"
+        stat -f -c '%S %b %f %a' "/proc/$pid/root$mp" 2>/dev/null | s="$source" t="$fstype" m="$mp" c="$c" awk '
+            function ceil(x) { return (x > int(x)) ? int(x) + 1 : int(x) }
+            $2 > 0 {
+                total = ceil($2 * $1 / 1024); used = ceil(($2 - $3) * $1 / 1024); avail = ceil($4 * $1 / 1024)
+                cap = (used + avail > 0) ? ceil(used * 100 / (used + avail)) : 0
+                printf "%s %s %.0f %.0f %.0f %d%% %s_container_%s\n", ENVIRON["s"], ENVIRON["t"], total, used, avail, cap, ENVIRON["m"], ENVIRON["c"]
+            }'
+    done | grep -E "$DF_FILTER"
+}
+
+collect_container ()
+{
+    #Collect one container into its own file so parallel output cannot interleave. A container which does not answer
+    #within DF_TIMEOUT is killed off and skipped, only completed output is moved into place.
+    timeout -k 2 $DF_TIMEOUT bash -c 'collect_df_'$DF_MODE' "$1" "$2"' _ "$1" "$2" > "$OUTDIR/.$1" && mv "$OUTDIR/.$1" "$OUTDIR/$1"
+}
 
+OUTDIR=$(mktemp -d /tmp/check_mk_docker_df.XXXXXX) || exit 1
+trap 'rm -rf "$OUTDIR"' EXIT
+export OUTDIR DF_TIMEOUT DF_MODE DF_FILTER
+export -f collect_df_exec collect_df_host collect_container
+
+containers=$(docker ps --format "{{.Names}}" | egrep -v $BLACKLIST)
+
+echo "<<<df>>>"
+if [ "$DF_MODE" == "host" ]; then
+    #one inspect call gives the pid of every container
+    [ -n "$containers" ] && docker inspect --format '{{.Name}} {{.State.Pid}}' $containers 2>/dev/null | sed 's#^/##' > "$OUTDIR/.pids"
+else
+    for c in $containers ; do echo "$c -" ; done > "$OUTDIR/.pids"
+fi
+xargs -r -n 2 -P $DF_WORKERS bash -c 'collect_container "$1" "$2"' _ < "$OUTDIR/.pids"
+#print in container order so the section is stable between runs
+for c in $containers ; do [ -e "$OUTDIR/$c" ] && cat "$OUTDIR/$c" ; done
@@ -0,0 +1,83 @@
+"""
+   fakedocker : stand-in for dockerd, serving canned api responses on a unix socket in a temp dir so DockerAPI can be
+                tested without docker.
+"""
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeDockerd:
+    """
+    routes maps an api path (without the query) to (status, body), or to a function taking the request handler for
+    responses which need more control. Unknown paths get a 404. Connections and requested paths are counted so tests
+    can check how the client used the socket.
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self.connections = 0
+        self.requests = []
+        self.handlers = {}
+        self.dir = tempfile.mkdtemp(prefix='fakedockerd')
+        self.path = os.path.join(self.dir, 'docker.sock')
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                fake.connections += 1
+                fake.handlers[threading.currentThread()] = self.request
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def finish(self):
+                fake.handlers.pop(threading.currentThread(), None)
+                BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+            def do_GET(self):
+                fake.requests.append(self.path)
+                route = fake.routes.get(self.path.split('?')[0], (404, '{"message":"no such path"}'))
+                if callable(route):
+                    route(self)
+                else:
+                    self.respond(*route)
+
+            def respond(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass    # clients giving up on slow responses are expected
+
+        self.server = Server(self.path, Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # handlers of kept-alive connections would otherwise still be reading when the interpreter exits
+        for thread, request in self.handlers.items():
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+        shutil.rmtree(self.dir)
@@ -0,0 +1,91 @@
+"""
+   Tests for the native engine of check_mk_apt, checked against dpkg itself.
+
+   Run with: python -m unittest discover tests
+"""
+import os
+import glob
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures', 'apt')
+
+
+def have(command):
+    return any(os.access(os.path.join(path, command), os.X_OK) for path in os.environ.get('PATH', '').split(':'))
+
+
+def stanzas(filename):
+    """
+    Yield each stanza of a dpkg status or Packages file as a dict
+    """
+    fields = {}
+    for line in open(filename):
+        line = line.rstrip('\n')
+        if not line:
+            if fields:
+                yield fields
+            fields = {}
+        elif ':' in line and not line[0].isspace():
+            key, value = line.split(':', 1)
+            fields[key] = value.strip()
+    if fields:
+        yield fields
+
+
+def dpkg_newer(a, b):
+    return subprocess.call(['dpkg', '--compare-versions', a, 'gt', b]) == 0
+
+
+def native_upgrade_list(arch):
+    """
+    Run native_upgrade_list from check_mk_apt, alone, against the fixtures
+    """
+    env = dict(os.environ, APT_LISTS=os.path.join(FIXTURES, 'lists'), DPKG_STATUS=os.path.join(FIXTURES, 'status'),
+               SECURITY_NAME='trusty-security', DPKG_ARCH=arch)
+    script = 'eval "$(sed -n \'/^native_upgrade_list ()/,/^}/p\' "$0")"; native_upgrade_list'
+    output = subprocess.check_output(['bash', '-c', script, os.path.join(ROOT, 'check_mk_apt')], env=env)
+    return sorted(output.splitlines())
+
+
+@unittest.skipUnless(have('bash') and have('awk') and have('dpkg'), "needs bash, awk and dpkg")
+class NativeUpgradeListTest(unittest.TestCase):
+    def expected(self, arch):
+        # the Inst lines apt-get -s upgrade would print, with the version ordering decided by dpkg
+        installed = {}
+        for fields in stanzas(os.path.join(FIXTURES, 'status')):
+            if fields['Status'].endswith(' installed'):
+                installed[(fields['Package'], fields['Architecture'])] = fields['Version']
+        candidate = {}
+        for filename in glob.glob(os.path.join(FIXTURES, 'lists', '*trusty-security*_Packages')):
+            for fields in stanzas(filename):
+                key = (fields['Package'], fields['Architecture'])
+                if key in installed and dpkg_newer(fields['Version'], installed[key]) and \
+                        (key not in candidate or dpkg_newer(fields['Version'], candidate[key])):
+                    candidate[key] = fields['Version']
+        lines = []
+        for (package, package_arch), version in candidate.items():
+            name = package if package_arch in (arch, 'all') else package + ':' + package_arch
+            lines.append("Inst %s [%s] (%s trusty-security [%s])" % (name, installed[(package, package_arch)],
+                                                                    version, package_arch))
+        return sorted(lines)
+
+    def test_matches_dpkg(self):
+        expected = self.expected('amd64')
+        self.assertEqual(native_upgrade_list('amd64'), expected)
+        # the fixtures are meant to have upgrades, but not everything, for the comparison to mean anything
+        self.assertTrue(10 < len(expected) < 25, expected)
+
+    def test_foreign_architecture(self):
+        lines = native_upgrade_list('amd64')
+        names = [line.split()[1] for line in lines]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertTrue('libc6' in names and 'libc6:i386' in names, names)
+        self.assertTrue('tzdata' in names, names)
+        names = [line.split()[1] for line in native_upgrade_list('i386')]
+        self.assertTrue('libc6:amd64' in names and 'libc6' in names, names)
+
+
+if __name__ == '__main__':
+    unittest.main()
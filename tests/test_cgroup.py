@@ -0,0 +1,137 @@
+"""
+   Tests for CgroupStats of check_mk_docker against fake cgroup v1 and v2 trees, with containers placed by both the
+   cgroupfs and the systemd cgroup drivers.
+
+   Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import check_mk_docker
+
+CID = '3f4e8a2b9c1d' * 5 + 'abcd'
+HOSTMEM = 8000000 * 1024
+NETDEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:    5000      50    0    0    0     0          0         0     5000      50    0    0    0     0       0          0
+  eth0:  123456     100    0    0    0     0          0         0    65432      90    0    0    0     0       0          0
+"""
+
+
+def write(root, path, data):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'w')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+class CgroupTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fakecgroup')
+        self.root = os.path.join(self.dir, 'cgroup')
+        self.proc = os.path.join(self.dir, 'proc')
+        os.makedirs(self.root)
+        write(self.dir, 'meminfo', "MemTotal:        8000000 kB\nMemFree:         1000000 kB\n")
+        write(self.proc, '4242/net/dev', NETDEV)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def stats(self):
+        return check_mk_docker.CgroupStats(self.root, 0, os.path.join(self.dir, 'meminfo'), self.proc)
+
+    def v1(self, container, limit='536870912'):
+        write(self.root, 'cpu,cpuacct/' + container + '/cpuacct.usage', "987654321\n")
+        write(self.root, 'memory/' + container + '/memory.usage_in_bytes', "300000000\n")
+        write(self.root, 'memory/' + container + '/memory.stat', "cache 100000000\nrss 190000000\n")
+        write(self.root, 'memory/' + container + '/memory.limit_in_bytes', limit + "\n")
+        write(self.root, 'memory/' + container + '/cgroup.procs', "4242\n4243\n")
+        write(self.root, 'blkio/' + container + '/blkio.throttle.io_service_bytes',
+              "8:0 Read 4096\n8:0 Write 8192\n8:16 Read 1000\n8:16 Write 24\n8:0 Total 12288\nTotal 13312\n")
+
+    def v2(self, container, limit='536870912'):
+        write(self.root, 'cgroup.controllers', "cpuset cpu io memory pids\n")
+        write(self.root, container + '/cpu.stat', "usage_usec 987654\nuser_usec 600000\nsystem_usec 387654\n")
+        write(self.root, container + '/memory.current', "300000000\n")
+        write(self.root, container + '/memory.stat', "anon 190000000\nfile 100000000\ninactive_file 100000000\n")
+        write(self.root, container + '/memory.max', limit + "\n")
+        write(self.root, container + '/cgroup.procs', "4242\n")
+        write(self.root, container + '/io.stat', "8:0 rbytes=4096 wbytes=8192 rios=1 wios=2\n"
+                                                 "8:16 rbytes=1000 wbytes=24 rios=1 wios=1\n")
+
+    def check_counters(self, cpu):
+        stats = self.stats()
+        self.assertEqual(stats.CPUUsage(CID), cpu)
+        self.assertEqual(stats.Memory(CID), (200000000, 536870912))
+        self.assertEqual(stats.BlockIO(CID), (5096, 8216))
+        self.assertEqual(stats.Network(CID), (123456, 65432))
+
+    def test_v1_cgroupfs(self):
+        self.v1('docker/' + CID)
+        self.assertFalse(self.stats().unified)
+        self.check_counters(987654321)
+
+    def test_v1_systemd(self):
+        self.v1('system.slice/docker-' + CID + '.scope')
+        self.check_counters(987654321)
+
+    def test_v1_separate_cpuacct(self):
+        self.v1('docker/' + CID)
+        os.rename(os.path.join(self.root, 'cpu,cpuacct'), os.path.join(self.root, 'cpuacct'))
+        self.assertEqual(self.stats().CPUUsage(CID), 987654321)
+
+    def test_v2_cgroupfs(self):
+        self.v2('docker/' + CID)
+        self.assertTrue(self.stats().unified)
+        self.check_counters(987654000)
+
+    def test_v2_systemd(self):
+        self.v2('system.slice/docker-' + CID + '.scope')
+        self.check_counters(987654000)
+
+    def test_v1_unlimited(self):
+        # v1 has no "unlimited", the limit is a huge page aligned number which docker reports as the host memory
+        self.v1('docker/' + CID, '9223372036854771712')
+        self.assertEqual(self.stats().Memory(CID), (200000000, HOSTMEM))
+
+    def test_v2_unlimited(self):
+        self.v2('system.slice/docker-' + CID + '.scope', 'max')
+        self.assertEqual(self.stats().Memory(CID), (200000000, HOSTMEM))
+
+    def test_missing_container(self):
+        self.v2('docker/' + CID)
+        stats = self.stats()
+        self.assertRaises(IOError, stats.CPUUsage, 'gone')
+        self.assertRaises(IOError, stats.Memory, 'gone')
+        self.assertEqual(stats.BlockIO('gone'), (0, 0))
+        self.assertEqual(stats.Network('gone'), (0, 0))
+
+    def test_counters_all(self):
+        self.v1('docker/' + CID)
+        containers = [{'id': CID, 'name': 'web'}, {'id': 'gone', 'name': 'gone'}]
+        counters, missing = self.stats().CountersAll(containers)
+        self.assertEqual(missing, [containers[1]])
+        self.assertEqual(len(counters), 1)
+        r = counters[0]
+        self.assertEqual((r['name'], r['cpu'], r['memused'], r['memtotal']), ('web', 987654321, 200000000, 536870912))
+        self.assertEqual((r['netin'], r['netout'], r['blkread'], r['blkwrite']), (123456, 65432, 5096, 8216))
+
+    def test_stats_all(self):
+        self.v2('docker/' + CID)
+        containers = [{'id': CID, 'name': 'web'}, {'id': 'gone', 'name': 'gone'}]
+        stats, missing = self.stats().StatsAll(containers)
+        self.assertEqual(missing, [containers[1]])
+        self.assertEqual([(s.name, s.cpu, s.memused, s.memtotal, s.mem) for s in stats],
+                         [('web', 0.0, 200000000, 536870912, 37.25)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,325 @@
+"""
+   Tests for check_mk_dnsdist.
+
+   Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import httplib
+import tempfile
+import StringIO
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import check_mk_dnsdist
+
+
+def server(name, address, pools, state='up', latency=1.5, qps=100.0, queries=1000, drops=0, outstanding=0):
+    return {'name': name, 'address': address, 'pools': pools, 'state': state, 'latency': latency, 'qps': qps,
+            'queries': queries, 'drops': drops, 'outstanding': outstanding}
+
+
+class FakeDnsdist:
+    """
+    Stand-in for the dnsdist webserver on a local port. routes maps a path to (status, body) or to a function taking
+    the request handler, connections and requests (path, api key) are recorded.
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self.connections = 0
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                fake.connections += 1
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                fake.requests.append((self.path, self.headers.get('X-API-Key')))
+                route = fake.routes.get(self.path, (404, 'Not Found'))
+                if callable(route):
+                    route(self)
+                else:
+                    self.respond(*route)
+
+            def respond(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+SERVERS = [server('a', '10.0.0.1:53', [])]
+DOCUMENT = json.dumps({'daemon_type': 'dnsdist', 'pools': [{'name': 'abuse', 'servers': 'sinkhole'}],
+                       'rules': [{'rule': 'qname==\\"servers\\": [{', 'action': 'to pool \\\\'}],
+                       'servers': SERVERS, 'version': 'dnsdist-1.3.3'}, sort_keys=True)
+
+
+def close_after_response(handler):
+    # answer, then drop the keep-alive connection without saying so
+    handler.respond(200, DOCUMENT)
+    handler.close_connection = 1
+
+
+def hang_up(handler):
+    handler.close_connection = 1
+
+
+def slow(handler):
+    time.sleep(0.5)
+    handler.respond(200, DOCUMENT)
+
+
+class ExtractJsonKeyTest(unittest.TestCase):
+    def test_top_level_only(self):
+        self.assertEqual(check_mk_dnsdist.extract_json_key(DOCUMENT, 'servers'), SERVERS)
+        self.assertEqual(check_mk_dnsdist.extract_json_key(DOCUMENT, 'version'), 'dnsdist-1.3.3')
+
+    def test_nested_only(self):
+        body = '{"pools": [{"name": "abuse", "servers": "sinkhole"}], "version": "1"}'
+        self.assertRaises(KeyError, check_mk_dnsdist.extract_json_key, body, 'servers')
+
+    def test_key_as_value(self):
+        body = '{"name": "servers", "list": ["servers"], "servers" : [1, 2]}'
+        self.assertEqual(check_mk_dnsdist.extract_json_key(body, 'servers'), [1, 2])
+
+    def test_depth(self):
+        self.assertEqual(check_mk_dnsdist.json_depth('{"a": [{"b": "}]\\"[{\\\\", "c": ['), 4)
+
+
+class DnsdistAPITest(unittest.TestCase):
+    def setUp(self):
+        self.dnsdist = FakeDnsdist({'/api/v1/servers/localhost': (200, DOCUMENT),
+                                    '/error': (500, 'Internal Server Error'),
+                                    '/drop': close_after_response,
+                                    '/hangup': hang_up,
+                                    '/slow': slow})
+        self.api = check_mk_dnsdist.DnsdistAPI(self.dnsdist.url + '/api/v1/servers/localhost', 'secret', 2, 5)
+
+    def tearDown(self):
+        self.api.close()
+        self.dnsdist.stop()
+
+    def test_keepalive(self):
+        self.assertEqual(self.api.get_json(key='servers'), SERVERS)
+        self.assertEqual(self.api.get_json()['version'], 'dnsdist-1.3.3')
+        self.assertEqual(self.dnsdist.connections, 1)
+        self.assertEqual(self.dnsdist.requests, [('/api/v1/servers/localhost', 'secret')] * 2)
+
+    def test_retry_once(self):
+        self.api.get('/drop')
+        self.assertEqual(self.api.get_json(key='servers'), SERVERS)
+        self.assertEqual(self.dnsdist.connections, 2)
+
+    def test_retry_gives_up(self):
+        self.assertRaises((httplib.HTTPException, socket.error), self.api.get, '/hangup')
+        self.assertEqual([r[0] for r in self.dnsdist.requests], ['/hangup', '/hangup'])
+        self.assertEqual(self.api.get_json(key='servers'), SERVERS)
+
+    def test_non_200(self):
+        try:
+            self.api.get('/error')
+        except IOError, e:
+            self.assertTrue('500' in str(e))
+        else:
+            self.fail("no error raised")
+        self.assertRaises(IOError, self.api.get, '/no/such/path')
+        self.assertEqual(self.api.get_json(key='servers'), SERVERS)
+        self.assertEqual(self.dnsdist.connections, 1)
+
+    def test_read_timeout(self):
+        api = check_mk_dnsdist.DnsdistAPI(self.dnsdist.url + '/slow', 'secret', 2, 0.1)
+        started = time.time()
+        try:
+            self.assertRaises(socket.timeout, api.get)
+            self.assertTrue(api.conn is None)
+        finally:
+            api.close()
+        self.assertTrue(time.time() - started < 0.4)
+
+    def test_collect_data(self):
+        check = check_mk_dnsdist.check_mk_dnsdist()
+        check.apiurl = self.dnsdist.url + '/error'
+        self.assertEqual(check.collect_data(), 0)
+        self.assertTrue(check.output.render().startswith("1 dnsdist_api - WARN - API is not responding (HTTP 500"))
+        check = check_mk_dnsdist.check_mk_dnsdist()
+        check.apiurl = self.dnsdist.url + '/api/v1/servers/localhost'
+        self.assertEqual(check.collect_data(), 1)
+        self.assertEqual(check.data, {'servers': SERVERS})
+        check.api.close()
+
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_dnsdist')
+        self.check = check_mk_dnsdist.check_mk_dnsdist()
+        self.check.config_cache = os.path.join(self.dir, 'check_mk_dnsdist.conf.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, text):
+        config = os.path.join(self.dir, 'check_mk_dnsdist.conf')
+        f = open(config, 'w')
+        f.write(text)
+        f.close()
+        self.check.load_config(config)
+
+    def test_converted(self):
+        self.load('debug=1\nurl="http://127.0.0.1:1/"\ntime_budget=2.5\nlatency_window=10\nbackend_latency_warn=20\n')
+        self.assertEqual(self.check.debug, 1)
+        self.assertEqual(self.check.apiurl, 'http://127.0.0.1:1/')
+        self.assertEqual(self.check.time_budget, 2.5)
+        self.assertEqual(self.check.latency_window, 10)
+        self.assertEqual(self.check.backend_latency_warn, 20)
+
+    def test_invalid_values(self):
+        # a typo keeps the default, or the setting made before the first section, and the run still reports
+        self.load('time_budget=5s\ninstance_timeout=3\nup_threshold=-1\n[vip1]\nurl="http://127.0.0.1:1/"\n'
+                  'instance_timeout=ten\nread_timeout=1,5\n')
+        self.assertEqual(self.check.time_budget, 50)
+        self.assertEqual(self.check.up_threshold, 1)
+        instance = self.check.instances[0]
+        self.assertEqual(instance.instance_timeout, 3)
+        self.assertEqual(instance.read_timeout, 5)
+        instance.state_file = os.path.join(self.dir, 'dnsdist_vip1.state')
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.check.run()
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([line.split(' ')[:2] for line in lines], [['1', 'dnsdist_vip1_api']])
+
+
+class ProcessDataTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_dnsdist')
+        self.check = check_mk_dnsdist.check_mk_dnsdist()
+        self.check.state_file = os.path.join(self.dir, 'dnsdist.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def process(self, servers):
+        self.check.data = {'servers': servers}
+        self.check.process_data()
+        lines = {}
+        for line in self.check.output.render().splitlines():
+            status, name, perfdata, description = line.split(' ', 3)
+            lines[name] = (int(status), perfdata, description)
+        self.check.output = check_mk_dnsdist.OutputBuffer()
+        self.check.budget = check_mk_dnsdist.TimeBudget(0, self.check.output)
+        return lines
+
+    def test_default_pool(self):
+        # dnsdist lists the members of the default pool with "pools": [] (or [""] on some versions)
+        lines = self.process([server('a', '10.0.0.1:53', []), server('b', '10.0.0.2:53', ['']),
+                              server('c', '10.0.0.3:53', ['abuse'], state='down', latency=None, qps=0.0)])
+        self.assertEqual(sorted(lines['dnsdist_qps'][1].split('|')), ['abuse=0.000', 'default=200.000'])
+        self.assertEqual(sorted(lines['dnsdist_pool_status'][1].split('|')), ['abuse=0', 'default=2'])
+        self.assertEqual(lines['dnsdist_pool_status'][0], 2)
+        self.assertEqual(lines['dnsdist_pool_status'][2], "CRIT - 1 pool(s) DOWN! (abuse)")
+        for name, (status, perfdata, description) in lines.items():
+            for value in perfdata.split('|'):
+                self.assertFalse(value.startswith('=') or value.startswith('_'), name + ": " + perfdata)
+
+
+    def percentiles(self, lines):
+        return dict(value.split('=') for value in lines['dnsdist_latency_percentiles'][1].split('|'))
+
+    def test_latency_window(self):
+        self.check.latency_window = 3
+        queries = 1000
+        for latency in (50.0, 50.0, 50.0, 1.0, 1.0):
+            queries += 1000
+            lines = self.process([server('a', '10.0.0.1:53', [], latency=latency, queries=queries)])
+        # two runs at 50ms still in the window of 3, the slow tail shows, the median does not
+        values = self.percentiles(lines)
+        self.assertAlmostEqual(float(values['default_p50']), 1.0, delta=0.09)
+        self.assertAlmostEqual(float(values['default_p99']), 50.0, delta=4.5)
+        queries += 1000
+        lines = self.process([server('a', '10.0.0.1:53', [], latency=1.0, queries=queries)])
+        values = self.percentiles(lines)
+        self.assertAlmostEqual(float(values['default_p99']), 1.0, delta=0.09)
+        # the window is kept as buckets, not raw samples
+        runs = self.check.load_state()['latency']['default']
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(runs[-1], [[check_mk_dnsdist.latency_bucket(1.0), 1000, 1]])
+
+    def test_latency_percentiles_weighted(self):
+        # one fast backend taking nearly all the traffic, many slow ones taking little
+        buckets = {check_mk_dnsdist.latency_bucket(0.5): [990, 1], check_mk_dnsdist.latency_bucket(80.0): [10, 20]}
+        p50, p99, p100 = check_mk_dnsdist.latency_percentiles(buckets, (50, 99, 100))
+        self.assertAlmostEqual(p50, 0.5, delta=0.045)
+        self.assertAlmostEqual(p99, 0.5, delta=0.045)
+        self.assertAlmostEqual(p100, 80.0, delta=7.2)
+        # without traffic the samples count equally
+        buckets = {check_mk_dnsdist.latency_bucket(0.5): [0, 1], check_mk_dnsdist.latency_bucket(80.0): [0, 20]}
+        self.assertAlmostEqual(check_mk_dnsdist.latency_percentiles(buckets, (50,))[0], 80.0, delta=7.2)
+        self.assertEqual(check_mk_dnsdist.latency_percentiles({}, (50, 99)), [0.0, 0.0])
+
+
+    def test_backend_identity(self):
+        self.check.per_backend = 1
+        lines = self.process([server('ns', '10.0.0.1:53', []), server('ns', '10.0.0.2:53', [], state='down'),
+                              server('ns', '10.0.0.1:53', []), server('a b', '10.0.0.3:53', []),
+                              server('a_b', '10.0.0.3:53', []), server('', '10.0.0.4:53', []),
+                              server('solo', '10.0.0.5:53', [])])
+        backends = sorted(name for name in lines if name.startswith('dnsdist_backend_'))
+        self.assertEqual(backends, ['dnsdist_backend_10.0.0.4_53', 'dnsdist_backend_a_b_10.0.0.3_53',
+                                    'dnsdist_backend_a_b_10.0.0.3_53_2', 'dnsdist_backend_ns_10.0.0.1_53',
+                                    'dnsdist_backend_ns_10.0.0.2_53', 'dnsdist_backend_solo'])
+        self.assertEqual(lines['dnsdist_backend_ns_10.0.0.1_53'][0], 0)
+        self.assertEqual(lines['dnsdist_backend_ns_10.0.0.2_53'][0], 2)
+
+
+    def test_latency_percentiles_interpolated(self):
+        # within a bucket the percentile moves linearly between its bounds rather than being rounded up
+        bucket = check_mk_dnsdist.latency_bucket(19.5)
+        lower = check_mk_dnsdist.bucket_latency(bucket - 1)
+        upper = check_mk_dnsdist.bucket_latency(bucket)
+        p25, p50, p100 = check_mk_dnsdist.latency_percentiles({bucket: [100, 4]}, (25, 50, 100))
+        self.assertAlmostEqual(p25, lower + (upper - lower) * 0.25)
+        self.assertAlmostEqual(p50, (lower + upper) / 2)
+        self.assertAlmostEqual(p100, upper)
+        self.assertTrue(p50 < 20 < upper, (p50, upper))
+        # a percentile falling on the edge of two buckets is their shared bound
+        buckets = {bucket - 1: [50, 1], bucket: [50, 1]}
+        self.assertAlmostEqual(check_mk_dnsdist.latency_percentiles(buckets, (50,))[0], lower)
+        self.assertAlmostEqual(check_mk_dnsdist.latency_percentiles({0: [10, 1]}, (50,))[0],
+                               check_mk_dnsdist.LATENCY_BUCKET_MIN / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
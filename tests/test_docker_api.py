@@ -0,0 +1,227 @@
+"""
+   Tests for the docker engine api client of check_mk_docker against a fake dockerd socket.
+
+   Run with: python -m unittest discover tests
+"""
+import time
+import unittest
+
+from fakedocker import FakeDockerd
+import check_mk_docker
+
+
+def close_after_response(handler):
+    # answer, then drop the keep-alive connection without telling the client as dockerd does with idle connections
+    handler.respond(200, '[{"Id": "0123456789abcdef", "Names": ["/web"]}]')
+    handler.close_connection = 1
+
+
+def hang_up(handler):
+    handler.close_connection = 1
+
+
+def slow(handler):
+    time.sleep(0.5)
+    handler.respond(200, '{}')
+
+
+class DockerAPITest(unittest.TestCase):
+    def setUp(self):
+        self.dockerd = FakeDockerd({
+            '/_ping': (200, 'OK'),
+            '/containers/json': (200, '[{"Id": "0123456789abcdef", "Names": ["/web"]}, {"Id": "fedcba9876543210"}]'),
+            '/info': (200, '{"MemTotal": 8201240051, "Driver": "overlay2"}'),
+            '/invalid': (200, '{"MemTotal": '),
+            '/error': (500, '{"message":"server error"}'),
+            '/drop': close_after_response,
+            '/hangup': hang_up,
+            '/slow': slow,
+        })
+        self.api = check_mk_docker.DockerAPI(self.dockerd.path, timeout=5)
+
+    def tearDown(self):
+        self.api.Close()
+        self.dockerd.stop()
+
+    def test_unix_connection(self):
+        conn = check_mk_docker.UnixHTTPConnection(self.dockerd.path, 5)
+        conn.request('GET', '/_ping')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), 'OK')
+        conn.close()
+
+    def test_available(self):
+        self.assertTrue(self.api.Available())
+        self.assertFalse(check_mk_docker.DockerAPI(self.dockerd.path + '.missing').Available())
+
+    def test_keepalive_reuse(self):
+        self.assertEqual(self.api.Request('/info')['Driver'], 'overlay2')
+        self.assertEqual(self.api.Containers(), [{'id': '0123456789abcdef', 'name': 'web'},
+                                                 {'id': 'fedcba9876543210', 'name': 'fedcba987654'}])
+        self.assertEqual(self.api.Request('/_ping', decode=False), 'OK')
+        self.assertEqual(self.dockerd.connections, 1)
+
+    def test_reconnect_once(self):
+        self.api.Request('/drop')
+        self.assertEqual(self.api.Request('/info')['MemTotal'], 8201240051)
+        self.assertEqual(self.dockerd.connections, 2)
+        self.assertEqual(self.dockerd.requests, ['/drop', '/info'])
+
+    def test_reconnect_gives_up(self):
+        self.assertRaises(check_mk_docker.DockerAPIError, self.api.Request, '/hangup')
+        self.assertEqual(self.dockerd.requests, ['/hangup', '/hangup'])
+        # the next call starts on a fresh connection
+        self.assertEqual(self.api.Request('/info')['Driver'], 'overlay2')
+
+    def test_non_200(self):
+        for path in ('/error', '/no/such/path'):
+            try:
+                self.api.Request(path)
+            except check_mk_docker.DockerTimeout:
+                self.fail("non 200 response raised as a timeout")
+            except check_mk_docker.DockerAPIError, e:
+                self.assertTrue(path in str(e))
+            else:
+                self.fail("no error raised for " + path)
+        # the connection is still usable after an error response
+        self.assertEqual(self.api.Request('/info')['Driver'], 'overlay2')
+        self.assertEqual(self.dockerd.connections, 1)
+
+    def test_invalid_json(self):
+        self.assertRaises(check_mk_docker.DockerAPIError, self.api.Request, '/invalid')
+        self.assertEqual(self.api.Request('/invalid', decode=False), '{"MemTotal": ')
+
+    def test_timeout(self):
+        api = check_mk_docker.DockerAPI(self.dockerd.path, timeout=0.1)
+        try:
+            self.assertRaises(check_mk_docker.DockerTimeout, api.Request, '/slow')
+            self.assertTrue(api.conn is None)
+        finally:
+            api.Close()
+
+    def test_missing_socket(self):
+        api = check_mk_docker.DockerAPI(self.dockerd.path + '.missing')
+        self.assertRaises(check_mk_docker.DockerAPIError, api.Request, '/info')
+
+
+class StatsDeadlineTest(unittest.TestCase):
+    """
+    Stats collection is cut off at StatsDeadline however many containers are still waiting
+    """
+    def setUp(self):
+        self.dockerd = FakeDockerd(dict([('/containers/slow' + str(i) + '/stats', slow) for i in range(10)]))
+        self.check = check_mk_docker.dockermon()
+        self.check.docker = check_mk_docker.DockerAPI(self.dockerd.path, timeout=5)
+        self.check.statsworkers = 2
+        self.check.statsdeadline = 0.8
+        self.containers = [{'id': 'slow' + str(i), 'name': 'slow-' + str(i)} for i in range(10)]
+
+    def tearDown(self):
+        self.check.docker.Close()
+        self.dockerd.stop()
+
+    def collect(self):
+        started = time.time()
+        stats = self.check.GetDockerStats(self.containers)
+        self.assertTrue(time.time() - started < self.check.statsdeadline + 0.4)
+        self.assertEqual([s.name for s in stats], [c['name'] for c in self.containers])
+        return stats
+
+    def test_parallel(self):
+        # two workers get through two containers each before the deadline
+        self.check.statsdeadline = 1.2
+        stats = self.collect()
+        self.assertEqual(len([s for s in stats if s.timedout]), 6)
+
+    def test_sequential(self):
+        # the container being sampled at the deadline is finished, the rest are not started
+        self.check.ParallelStats = "no"
+        stats = self.collect()
+        self.assertEqual(len([s for s in stats if s.timedout]), 8)
+
+    def test_sequential_timeout(self):
+        self.check.ParallelStats = "no"
+        self.check.statsdeadline = 30
+        self.check.docker.timeout = 0.1
+        stats = self.collect()
+        self.assertEqual([s.timedout for s in stats], [True] * 10)
+
+
+
+class MonitorMetricsTest(unittest.TestCase):
+    """
+    Docker_Metrics (the cpu and memory totals) with the settings a run starts with when the config does not set them
+    """
+    STATS = ('{"cpu_stats": {"cpu_usage": {"total_usage": 3000}, "system_cpu_usage": 20000, "online_cpus": 2}, '
+             '"precpu_stats": {"cpu_usage": {"total_usage": 1000}, "system_cpu_usage": 10000}, '
+             '"memory_stats": {"usage": 256, "limit": 1024}}')
+
+    def setUp(self):
+        self.dockerd = FakeDockerd({'/containers/abc/stats': (200, self.STATS),
+                                    '/info': (200, '{"MemTotal": 4096, "Driver": "overlay2"}')})
+        self.check = check_mk_docker.dockermon()
+        self.check.docker = check_mk_docker.DockerAPI(self.dockerd.path, timeout=5)
+        self.check.running_containers = [{'id': 'abc', 'name': 'web'}]
+
+    def tearDown(self):
+        self.check.docker.Close()
+        self.dockerd.stop()
+
+    def test_defaults(self):
+        self.check.MonitorMetrics()
+        lines = self.check.out.render().splitlines()
+        self.assertEqual(sorted(line.split(' ')[1] for line in lines), ['Docker_CPU_Total', 'Docker_Memory_Total'])
+        self.assertEqual([line.split(' ')[0] for line in lines], ['0', '0'])
+
+    def test_display_all(self):
+        self.check.DisplayAllContainers = "True"
+        self.check.MonitorMetrics()
+        names = sorted(line.split(' ')[1] for line in self.check.out.render().splitlines())
+        self.assertEqual(names, ['Container_CPU_web', 'Container_Memory_web',
+                                 'Docker_CPU_Total', 'Docker_Memory_Total'])
+
+
+
+class RunStepTest(unittest.TestCase):
+    """
+    A check abandoned by the time budget keeps its docker connection to itself, the checks of the next collection
+    do not send their requests on it
+    """
+    def setUp(self):
+        self.dockerd = FakeDockerd({'/slow': slow, '/info': (200, '{"MemTotal": 4096}')})
+        self.check = check_mk_docker.dockermon()
+        self.check.docker = check_mk_docker.DockerAPI(self.dockerd.path, timeout=5)
+        self.check.budget = check_mk_docker.TimeBudget(0.2, self.check.out)
+        self.clients = []
+
+    def tearDown(self):
+        # let the abandoned check finish before the fake goes away
+        waited = time.time()
+        while self.check.stepclients and time.time() - waited < 5:
+            time.sleep(0.05)
+        time.sleep(0.05)
+        self.check.docker.Close()
+        self.dockerd.stop()
+
+    def request(self, path):
+        docker = self.check.Docker()
+        self.clients.append(docker)
+        return docker.Request(path)
+
+    def test_abandoned_step(self):
+        self.assertEqual(self.check.RunStep('Slow', self.request, '/slow'), None)
+        # the next --daemon collection starts with a fresh budget while the abandoned check is still reading
+        self.check.budget = check_mk_docker.TimeBudget(5, check_mk_docker.OutputBuffer())
+        self.assertEqual(self.check.RunStep('Info', self.request, '/info'), {'MemTotal': 4096})
+        self.assertEqual(len(set(self.clients)), 2)
+        self.assertFalse(self.check.docker in self.clients)
+        # the abandoned check still has its client, the finished one has closed and dropped its own
+        self.assertEqual(self.check.stepclients.values(), [self.clients[0]])
+        self.assertEqual(self.clients[1].conn, None)
+        lines = self.check.out.render().splitlines()
+        self.assertEqual([line.split(' ')[:2] for line in lines], [['3', 'Slow']])
+
+
+if __name__ == '__main__':
+    unittest.main()
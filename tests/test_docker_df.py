@@ -0,0 +1,63 @@
+"""
+   Tests for the host mode of check_mk_docker_df.sh against a fake /proc/<pid> of a container.
+
+   Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# mount points as the kernel writes them in mountinfo, with space, tab and backslash escaped as octal
+MOUNTS = [
+    ('/data', '/data'),
+    ('/srv/my\\040volume', '/srv/my volume'),
+    ('/srv/tab\\011and\\134backslash', '/srv/tab\tand\\backslash'),
+    # a digit right after an escape is not part of it
+    ('/srv/vol\\0401', '/srv/vol 1'),
+]
+
+
+def have(command):
+    return any(os.access(os.path.join(path, command), os.X_OK) for path in os.environ.get('PATH', '').split(':'))
+
+
+@unittest.skipUnless(have('bash') and have('awk') and have('stat'), "needs bash, awk and stat")
+class HostModeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_docker_df')
+        f = open(os.path.join(self.dir, 'mountinfo'), 'w')
+        for i, (escaped, path) in enumerate(MOUNTS):
+            f.write("{0} 1 8:1 / {1} rw,relatime shared:1 - ext4 /dev/disk\\040{0} rw\n".format(i + 30, escaped))
+            os.makedirs(os.path.join(self.dir, 'root') + path)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def collect(self):
+        # the function reads /proc/<pid>/mountinfo and /proc/<pid>/root, a pid climbing out of /proc points it at
+        # the fake instead
+        pid = 'self/../..' + self.dir
+        script = 'eval "$(sed -n \'/^collect_df_host ()/,/^}/p\' "$0")"; collect_df_host web "$1"'
+        env = dict(os.environ, DF_FILTER='.')
+        return subprocess.check_output(['bash', '-c', script, os.path.join(ROOT, 'check_mk_docker_df.sh'), pid],
+                                       env=env).splitlines()
+
+    def test_escaped_mount_points(self):
+        lines = self.collect()
+        self.assertEqual(len(lines), len(MOUNTS), lines)
+        for i, (line, (escaped, path)) in enumerate(zip(lines, MOUNTS)):
+            # the source device is escaped too, "/dev/disk\\040<n>" is the device "/dev/disk <n>"
+            self.assertTrue(line.startswith('/dev/disk {0} '.format(i + 30)), line)
+            self.assertTrue(line.endswith(' ' + path + '_container_web'), line)
+            fields = line.split(' ')
+            self.assertEqual(fields[2], 'ext4')
+            self.assertTrue(int(fields[3]) > 0, line)
+
+
+if __name__ == '__main__':
+    unittest.main()
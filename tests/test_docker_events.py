@@ -0,0 +1,142 @@
+"""
+   Tests for following the docker events stream (DockerAPI.Events) into a ContainerTable, against a fake dockerd
+   sending the events as a chunked response with the json split across chunk boundaries.
+
+   Run with: python -m unittest discover tests
+"""
+import json
+import time
+import unittest
+
+from fakedocker import FakeDockerd
+import check_mk_docker
+
+WEB = 'a1' * 32
+DB = 'b2' * 32
+JOB = 'c3' * 32
+OLDJOB = 'd4' * 32
+NOW = int(time.time())
+
+
+def event(action, cid, name, when):
+    return {'Type': 'container', 'Action': action, 'Actor': {'ID': cid, 'Attributes': {'name': name}},
+            'time': when}
+
+
+EVENTS = [
+    # web is restarted three times within a minute, seven transitions so it is flapping
+    event('die', WEB, 'web', NOW - 60), event('start', WEB, 'web', NOW - 55),
+    event('kill', WEB, 'web', NOW - 40), event('die', WEB, 'web', NOW - 40), event('start', WEB, 'web', NOW - 35),
+    event('die', WEB, 'web', NOW - 20),
+    {'status': 'start', 'id': WEB, 'from': 'nginx', 'time': NOW - 15},     # pre 1.22 event format
+    # db is renamed and keeps its history under the new name
+    event('die', DB, 'db', NOW - 30), event('start', DB, 'db', NOW - 29), event('rename', DB, 'db-old', NOW - 10),
+    # a --rm job which ran long ago is forgotten as soon as it is destroyed, a recent one once it ages out
+    event('start', OLDJOB, 'oldjob', NOW - 1000), event('die', OLDJOB, 'oldjob', NOW - 990),
+    event('destroy', OLDJOB, 'oldjob', NOW - 5),
+    event('start', JOB, 'job', NOW - 8), event('die', JOB, 'job', NOW - 4), event('destroy', JOB, 'job', NOW - 3),
+]
+
+
+def chunked(body, size):
+    return "".join(["{0:x}\r\n{1}\r\n".format(len(body[i:i + size]), body[i:i + size])
+                    for i in range(0, len(body), size)]) + "0\r\n\r\n"
+
+
+def stream(body, size=37):
+    def respond(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        handler.wfile.write(chunked(body, size))
+        handler.close_connection = 1
+    return respond
+
+
+class EventsTest(unittest.TestCase):
+    def setUp(self):
+        self.dockerd = FakeDockerd({})
+        self.api = check_mk_docker.DockerAPI(self.dockerd.path, timeout=5)
+
+    def tearDown(self):
+        self.api.Close()
+        self.dockerd.stop()
+
+    def follow(self, events, size=37):
+        self.dockerd.routes['/events'] = stream("".join([json.dumps(e) + "\n" for e in events]), size)
+        return list(self.api.Events(NOW - 100))
+
+    def test_chunk_boundaries(self):
+        for size in (1, 7, 37, 4096):
+            self.assertEqual(self.follow(EVENTS, size), EVENTS)
+        self.assertTrue(self.dockerd.requests[-1].startswith('/events?filters='))
+        self.assertTrue(self.dockerd.requests[-1].endswith('&since=' + str(NOW - 100)))
+
+    def test_table(self):
+        table = check_mk_docker.ContainerTable(flapwindow=300, flapthreshold=4)
+        table.Load([{'id': WEB, 'name': 'web'}, {'id': DB, 'name': 'db'}])
+        for e in self.follow(EVENTS):
+            table.Apply(e)
+
+        self.assertEqual(sorted([(c['name'], c['id']) for c in table.Containers()]), [('db-old', DB), ('web', WEB)])
+        self.assertEqual(table.Summary('web'), (3, True))
+        self.assertEqual(table.Summary(WEB[:12]), (3, True))
+        self.assertEqual(table.Summary('db-old'), (1, False))
+        self.assertEqual(table.Summary('db'), None)
+        self.assertEqual(table.Summary('oldjob'), None)
+        self.assertFalse(OLDJOB in table.ids)
+        # the recent job is kept until its transitions leave the flap window
+        self.assertEqual(table.Summary('job'), (0, False))
+        self.assertFalse(JOB in table.ids)
+        self.assertEqual(table.Totals(), (4, 1))
+
+        table.lock.acquire()
+        try:
+            table.Prune(NOW + 300)
+        finally:
+            table.lock.release()
+        self.assertEqual(sorted(table.containers.keys()), ['db-old', 'web'])
+        self.assertEqual(sorted(table.ids.values()), ['db-old', 'web'])
+
+    def test_recreated_container_keeps_history(self):
+        table = check_mk_docker.ContainerTable()
+        table.Load([{'id': JOB, 'name': 'app'}])
+        for e in self.follow([event('die', JOB, 'app', NOW - 3), event('destroy', JOB, 'app', NOW - 2),
+                              event('start', OLDJOB, 'app', NOW - 1)]):
+            table.Apply(e)
+        self.assertEqual(table.Containers(), [{'id': OLDJOB, 'name': 'app'}])
+        self.assertEqual(table.Summary('app'), (1, False))
+        self.assertEqual(table.ids, {OLDJOB: 'app'})
+
+    def test_restarts_survive_prune(self):
+        table = check_mk_docker.ContainerTable(flapwindow=300, flapthreshold=4)
+        table.Load([{'id': WEB, 'name': 'web'}, {'id': JOB, 'name': 'job'}])
+        for e in self.follow([event('die', JOB, 'job', NOW - 900), event('start', JOB, 'job', NOW - 890),
+                              event('die', JOB, 'job', NOW - 880), event('start', WEB, 'web', NOW - 870)]):
+            table.Apply(e)
+        self.assertEqual(table.Totals(), (1, 0))
+        # the job is forgotten once destroyed, its restart is still counted
+        table.Apply(event('destroy', JOB, 'job', NOW))
+        self.assertEqual(table.Summary('job'), None)
+        self.assertEqual(table.Totals(), (1, 0))
+        # recreated under the same name it starts a new history, its first start is not a restart
+        table.Apply(event('start', OLDJOB, 'job', NOW))
+        table.Apply(event('die', OLDJOB, 'job', NOW))
+        table.Apply(event('start', OLDJOB, 'job', NOW))
+        self.assertEqual(table.Summary('job'), (1, False))
+        self.assertEqual(table.Totals(), (2, 0))
+
+    def test_invalid_json(self):
+        self.dockerd.routes['/events'] = stream('{"Action": "start"}\n{"Action": }\n')
+        events = self.api.Events()
+        self.assertEqual(events.next(), {'Action': 'start'})
+        self.assertRaises(check_mk_docker.DockerAPIError, events.next)
+
+    def test_non_200(self):
+        self.dockerd.routes['/events'] = (500, '{"message":"server error"}')
+        self.assertRaises(check_mk_docker.DockerAPIError, list, self.api.Events())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+   Tests for the entry points of check_mk_docker and check_mk_dnsdist as the agent starts them.
+
+   Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import check_mk_docker
+import check_mk_dnsdist
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MainTest(unittest.TestCase):
+    """
+    main() reads, and when missing generates, its config in MK_CONFDIR
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_main')
+        self.environ = dict(os.environ)
+        os.environ['MK_CONFDIR'] = self.dir
+        os.environ['MK_VARDIR'] = self.dir
+        self.argv = sys.argv
+        sys.argv = ['check_mk']
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        sys.argv = self.argv
+        shutil.rmtree(self.dir)
+
+    def test_docker_generates_config(self):
+        locate = check_mk_docker.dockermon.LocateDocker
+        check_mk_docker.dockermon.LocateDocker = lambda self: None
+        try:
+            self.assertRaises(SystemExit, check_mk_docker.main)
+        finally:
+            check_mk_docker.dockermon.LocateDocker = locate
+        config = os.path.join(self.dir, 'dockermon.conf')
+        self.assertTrue(os.path.isfile(config))
+        p = check_mk_docker.dockermon()
+        p.configcache = os.path.join(self.dir, 'dockermon.conf.cache')
+        p.LoadConfig(config)
+        self.assertEqual(p.configerrors, [])
+
+    def test_dnsdist_generates_config(self):
+        self.assertRaises(SystemExit, check_mk_dnsdist.main)
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'check_mk_dnsdist.conf')))
+
+
+class ScriptTest(unittest.TestCase):
+    """
+    A plugin run as a script does the check, unless the agent has its executable next to it to do that
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_main')
+        self.plugins = os.path.join(self.dir, 'local')
+        os.mkdir(self.plugins)
+        for name in ('check_mk_docker.py', 'check_mk_dnsdist.py', 'check_mk_common.py'):
+            shutil.copy(os.path.join(ROOT, name), self.plugins)
+        self.env = dict(os.environ, MK_CONFDIR=self.dir, MK_VARDIR=self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_script(self, name):
+        proc = subprocess.Popen([sys.executable, os.path.join(self.plugins, name)], env=self.env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        return proc.returncode, out
+
+    def install_wrapper(self, name):
+        shutil.copy(os.path.join(ROOT, name), self.plugins)
+        os.chmod(os.path.join(self.plugins, name), 0755)
+
+    def test_dnsdist_alone(self):
+        # no config yet, one is generated and the run ends there
+        self.assertEqual(self.run_script('check_mk_dnsdist.py'), (1, ''))
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'check_mk_dnsdist.conf')))
+
+    def test_dnsdist_with_wrapper(self):
+        self.install_wrapper('check_mk_dnsdist')
+        self.assertEqual(self.run_script('check_mk_dnsdist.py'), (0, ''))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'check_mk_dnsdist.conf')))
+
+    def test_docker_alone(self):
+        # exits 2 without a docker binary, 1 generating the config, either way it ran
+        self.assertNotEqual(self.run_script('check_mk_docker.py')[0], 0)
+
+    def test_docker_with_wrapper(self):
+        self.install_wrapper('check_mk_docker')
+        self.assertEqual(self.run_script('check_mk_docker.py'), (0, ''))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'dockermon.conf')))
+
+    def test_executable_mode(self):
+        # installs from before the executables run the plugin itself, it has to stay executable
+        self.assertTrue(os.access(os.path.join(ROOT, 'check_mk_docker.py'), os.X_OK))
+        self.assertTrue(os.access(os.path.join(ROOT, 'check_mk_docker'), os.X_OK))
+
+
+if __name__ == '__main__':
+    unittest.main()